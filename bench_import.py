@@ -0,0 +1,70 @@
+#!/usr/bin/python
+#
+# import-time benchmark for libtcodpy
+#
+# runs each snippet in a fresh interpreter several times and prints the best
+# and median wall time, minus the time of a bare interpreter start:
+#   lazy  - plain "import libtcodpy", which no longer opens the library
+#   eager - import, then open the library and set up every declared function,
+#           which is what every import used to pay for
+#
+# usage: python bench_import.py [runs]
+#
+
+import os
+import subprocess
+import sys
+import time
+
+RUNS = 20
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+SNIPPETS = [
+    ('python', 'pass'),
+    ('lazy', 'import libtcodpy'),
+    ('eager', 'import libtcodpy\n'
+              'for name in list(libtcodpy._lib._restypes):\n'
+              '    getattr(libtcodpy._lib, name, None)'),
+]
+
+
+def time_snippet(code, runs):
+    #wall time of each run of the snippet in a new interpreter
+    times = []
+    devnull = open(os.devnull, 'w')
+    try:
+        for i in range(runs):
+            start = time.time()
+            status = subprocess.call([sys.executable, '-c', code], cwd=HERE,
+                                     stderr=devnull)
+            times.append(time.time() - start)
+            if status != 0:
+                return None
+    finally:
+        devnull.close()
+    return sorted(times)
+
+
+def main():
+    runs = RUNS
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+
+    base = None
+    for label, code in SNIPPETS:
+        times = time_snippet(code, runs)
+        if times is None:
+            print('%-8s failed (is libtcod available? set LIBTCOD_PATH)' % label)
+            continue
+        best = times[0]
+        median = times[len(times) // 2]
+        if base is None:
+            base = best
+            print('%-8s best %7.1f ms  median %7.1f ms' % (label, best * 1000, median * 1000))
+        else:
+            print('%-8s best %7.1f ms  median %7.1f ms  (+%.1f ms over python)' % (
+                label, best * 1000, median * 1000, (best - base) * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -25,10 +25,15 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import os
 import sys
 import ctypes
 import struct
+import marshal
+import hashlib
 from ctypes import *
+from array import array
+from heapq import heappush, heappop
 
 if not hasattr(ctypes, "c_bool"):   # for Python < 2.6
     c_bool = c_uint8
@@ -43,37 +48,109 @@ LINUX=False
 MAC=False
 MINGW=False
 MSVC=False
+HAIKU=False
 if sys.platform.find('linux') != -1:
-    _lib = ctypes.cdll['./libtcod.so']
+    _LIB_NAMES = ('libtcod.so',)
     LINUX=True
 elif sys.platform.find('darwin') != -1:
-    _lib = ctypes.cdll['./libtcod.dylib']
+    _LIB_NAMES = ('libtcod.dylib',)
     MAC = True
 elif sys.platform.find('haiku') != -1:
-    _lib = ctypes.cdll['./libtcod.so']
+    _LIB_NAMES = ('libtcod.so',)
     HAIKU = True
 else:
-    try:
-        _lib = ctypes.cdll['./libtcod-mingw.dll']
-        MINGW=True
-    except WindowsError:
-        _lib = ctypes.cdll['./libtcod-VS.dll']
-        MSVC=True
-    # On Windows, ctypes doesn't work well with function returning structs,
-    # so we have to user the _wrapper functions instead
-    _lib.TCOD_color_multiply = _lib.TCOD_color_multiply_wrapper
-    _lib.TCOD_color_add = _lib.TCOD_color_add_wrapper
-    _lib.TCOD_color_multiply_scalar = _lib.TCOD_color_multiply_scalar_wrapper
-    _lib.TCOD_color_subtract = _lib.TCOD_color_subtract_wrapper
-    _lib.TCOD_color_lerp = _lib.TCOD_color_lerp_wrapper
-    _lib.TCOD_console_get_default_background = _lib.TCOD_console_get_default_background_wrapper
-    _lib.TCOD_console_get_default_foreground = _lib.TCOD_console_get_default_foreground_wrapper
-    _lib.TCOD_console_get_char_background = _lib.TCOD_console_get_char_background_wrapper
-    _lib.TCOD_console_get_char_foreground = _lib.TCOD_console_get_char_foreground_wrapper
-    _lib.TCOD_console_get_fading_color = _lib.TCOD_console_get_fading_color_wrapper
-    _lib.TCOD_image_get_pixel = _lib.TCOD_image_get_pixel_wrapper
-    _lib.TCOD_image_get_mipmap_pixel = _lib.TCOD_image_get_mipmap_pixel_wrapper
-    _lib.TCOD_parser_get_color_property = _lib.TCOD_parser_get_color_property_wrapper
+    _LIB_NAMES = ('libtcod-mingw.dll', 'libtcod-VS.dll')
+
+# On Windows, ctypes doesn't work well with function returning structs,
+# so we have to user the _wrapper functions instead
+_WINDOWS_ALIASES = {}
+if not (LINUX or MAC or HAIKU):
+    for _name in ('TCOD_color_multiply', 'TCOD_color_add',
+                  'TCOD_color_multiply_scalar', 'TCOD_color_subtract',
+                  'TCOD_color_lerp', 'TCOD_console_get_default_background',
+                  'TCOD_console_get_default_foreground',
+                  'TCOD_console_get_char_background',
+                  'TCOD_console_get_char_foreground',
+                  'TCOD_console_get_fading_color', 'TCOD_image_get_pixel',
+                  'TCOD_image_get_mipmap_pixel',
+                  'TCOD_parser_get_color_property'):
+        _WINDOWS_ALIASES[_name] = _name + '_wrapper'
+
+def _find_library():
+    # candidate paths for the native library, in order: $LIBTCOD_PATH (a
+    # file or a directory), the directory of this module, the current
+    # directory, then the system search path.
+    candidates = []
+    env = os.environ.get('LIBTCOD_PATH')
+    if env:
+        if os.path.isdir(env):
+            candidates.extend(os.path.join(env, name) for name in _LIB_NAMES)
+        else:
+            candidates.append(env)
+    here = os.path.dirname(os.path.abspath(__file__))
+    candidates.extend(os.path.join(here, name) for name in _LIB_NAMES)
+    candidates.extend(os.path.join(os.getcwd(), name) for name in _LIB_NAMES)
+    import ctypes.util
+    found = ctypes.util.find_library('tcod')
+    if found:
+        candidates.append(found)
+    unique = []
+    for path in candidates:
+        if path not in unique:
+            unique.append(path)
+    return unique
+
+class _Library(object):
+    # the libtcod binding, loaded on first use. importing this module only
+    # records which restype each function needs (declare); the library is
+    # resolved and opened the first time a TCOD_ function is looked up, and
+    # each function gets its restype (and Windows alias) when it is first
+    # fetched, then is cached as a plain attribute.
+    def __init__(self):
+        self._dll = None
+        self._restypes = {}
+
+    def declare(self, name, restype):
+        self._restypes[name] = restype
+        if self._dll is not None and name in self.__dict__:
+            self.__dict__[name].restype = restype
+
+    def load(self):
+        global MINGW, MSVC
+        if self._dll is not None:
+            return self._dll
+        errors = []
+        for path in _find_library():
+            if os.path.isabs(path) and not os.path.exists(path):
+                continue
+            try:
+                dll = ctypes.CDLL(path)
+            except OSError as e:
+                errors.append(str(e))
+                continue
+            name = os.path.basename(path)
+            MINGW = name == 'libtcod-mingw.dll'
+            MSVC = name == 'libtcod-VS.dll'
+            self._dll = dll
+            break
+        else:
+            raise OSError('libtcod not found. tried:\n  ' + '\n  '.join(errors or _find_library()))
+        if MAC:
+            from cprotos import setup_protos
+            setup_protos(self)
+        return self._dll
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        dll = self.load()
+        f = getattr(dll, _WINDOWS_ALIASES.get(name, name))
+        if name in self._restypes:
+            f.restype = self._restypes[name]
+        setattr(self, name, f)
+        return f
+
+_lib = _Library()
 
 HEXVERSION = 0x010501
 STRVERSION = "1.5.1"
@@ -123,17 +200,11 @@ class Color(Structure):
         yield self.g
         yield self.b
 
-# Should be valid on any platform, check it!  Has to be done after Color is defined.
-if MAC:
-    from cprotos import setup_protos
-    setup_protos(_lib)
-
-_lib.TCOD_color_equals.restype = c_bool
-_lib.TCOD_color_multiply.restype = Color
-_lib.TCOD_color_multiply_scalar.restype = Color
-_lib.TCOD_color_add.restype = Color
-_lib.TCOD_color_subtract.restype = Color
-
+_lib.declare('TCOD_color_equals', c_bool)
+_lib.declare('TCOD_color_multiply', Color)
+_lib.declare('TCOD_color_multiply_scalar', Color)
+_lib.declare('TCOD_color_add', Color)
+_lib.declare('TCOD_color_subtract', Color)
 # default colors
 # grey levels
 black=Color(0,0,0)
@@ -357,7 +428,7 @@ celadon=Color(172,255,175)
 peach=Color(255,159,127)
 
 # color functions
-_lib.TCOD_color_lerp.restype = Color
+_lib.declare('TCOD_color_lerp', Color)
 def color_lerp(c1, c2, a):
     return _lib.TCOD_color_lerp(c1, c2, c_float(a))
 
@@ -381,6 +452,128 @@ def color_gen_map(colors, indexes):
     _lib.TCOD_color_gen_map(cres, len(colors), ccolors, cindexes)
     return cres
 
+# packed colors. a color packs into one int as 0xRRGGBB, and the colors_*
+# functions work on whole sequences of them in Python (or vectorized, for
+# NumPy arrays) instead of one library call per Color. they follow libtcod's
+# rounding: lerp truncates, scale truncates and clamps to 0..255. results are
+# array('i'), or NumPy arrays when given NumPy input.
+def color_pack(c):
+    return (c[0] << 16) | (c[1] << 8) | c[2]
+
+def color_unpack(v):
+    return Color((v >> 16) & 0xff, (v >> 8) & 0xff, v & 0xff)
+
+def _packed(seq):
+    if numpy_available and isinstance(seq, numpy.ndarray):
+        return seq
+    if isinstance(seq, array) and seq.typecode == 'i':
+        return seq
+    return array('i', seq)
+
+def colors_split(packed):
+    # (r, g, b) channels of packed colors, ready for console_fill_background
+    # and console_fill_foreground.
+    packed = _packed(packed)
+    if numpy_available and isinstance(packed, numpy.ndarray):
+        packed = numpy.asarray(packed, dtype=numpy.intc)
+        return (packed >> 16) & 0xff, (packed >> 8) & 0xff, packed & 0xff
+    return (array('i', [(v >> 16) & 0xff for v in packed]),
+            array('i', [(v >> 8) & 0xff for v in packed]),
+            array('i', [v & 0xff for v in packed]))
+
+def colors_join(r, g, b):
+    # pack three channel sequences back into colors.
+    if numpy_available and isinstance(r, numpy.ndarray):
+        return ((numpy.asarray(r, dtype=numpy.intc) << 16) |
+                (numpy.asarray(g, dtype=numpy.intc) << 8) |
+                numpy.asarray(b, dtype=numpy.intc))
+    return array('i', [(cr << 16) | (cg << 8) | cb for cr, cg, cb in zip(r, g, b)])
+
+def colors_lerp(c1, c2, coef):
+    # per-element lerp from c1 to c2. coef is a float or a sequence of them.
+    r1, g1, b1 = colors_split(c1)
+    r2, g2, b2 = colors_split(c2)
+    if numpy_available and isinstance(r1, numpy.ndarray):
+        coef = numpy.asarray(coef, dtype=numpy.float32)
+        return colors_join((r1 + (r2 - r1) * coef).astype(numpy.intc),
+                           (g1 + (g2 - g1) * coef).astype(numpy.intc),
+                           (b1 + (b2 - b1) * coef).astype(numpy.intc))
+    n = len(r1)
+    if isinstance(coef, (int, float)):
+        coef = [coef] * n
+    out = array('i', [0]) * n
+    for i in range(n):
+        a = coef[i]
+        out[i] = ((int(r1[i] + (r2[i] - r1[i]) * a) << 16) |
+                  (int(g1[i] + (g2[i] - g1[i]) * a) << 8) |
+                  int(b1[i] + (b2[i] - b1[i]) * a))
+    return out
+
+def colors_scale(c, value):
+    # multiply colors by a float, or a sequence of floats, clamped to 0..255.
+    r, g, b = colors_split(c)
+    if numpy_available and isinstance(r, numpy.ndarray):
+        value = numpy.asarray(value, dtype=numpy.float32)
+        return colors_join(numpy.clip((r * value).astype(numpy.intc), 0, 255),
+                           numpy.clip((g * value).astype(numpy.intc), 0, 255),
+                           numpy.clip((b * value).astype(numpy.intc), 0, 255))
+    n = len(r)
+    if isinstance(value, (int, float)):
+        value = [value] * n
+    out = array('i', [0]) * n
+    for i in range(n):
+        v = value[i]
+        out[i] = ((max(0, min(255, int(r[i] * v))) << 16) |
+                  (max(0, min(255, int(g[i] * v))) << 8) |
+                  max(0, min(255, int(b[i] * v))))
+    return out
+
+def colors_blend(back, fore, flag):
+    # blend fore over back per element, like the console background flags:
+    # BKGND_SET, BKGND_MULTIPLY, BKGND_LIGHTEN, BKGND_DARKEN, BKGND_SCREEN or
+    # BKGND_ADD. for an alpha blend use colors_lerp(back, fore, alpha).
+    if flag == BKGND_SET:
+        return _packed(fore)
+    if flag == BKGND_MULTIPLY:
+        op = lambda b, f: b * f // 255
+    elif flag == BKGND_LIGHTEN:
+        op = max
+    elif flag == BKGND_DARKEN:
+        op = min
+    elif flag == BKGND_SCREEN:
+        op = lambda b, f: 255 - (255 - b) * (255 - f) // 255
+    elif flag == BKGND_ADD:
+        op = lambda b, f: min(255, b + f)
+    else:
+        raise ValueError('colors_blend: unsupported blend flag %r.' % (flag,))
+    br, bg, bb = colors_split(back)
+    fr, fg, fb = colors_split(fore)
+    if numpy_available and isinstance(br, numpy.ndarray):
+        if op is max:
+            op = numpy.maximum
+        elif op is min:
+            op = numpy.minimum
+        elif flag == BKGND_ADD:
+            op = lambda b, f: numpy.minimum(255, b + f)
+        return colors_join(op(br, fr), op(bg, fg), op(bb, fb))
+    return array('i', [(op(br[i], fr[i]) << 16) | (op(bg[i], fg[i]) << 8) | op(bb[i], fb[i])
+                       for i in range(len(br))])
+
+def color_palette(colors, indexes):
+    # color_gen_map as a packed lookup table: palette[k] is the gradient color
+    # at step k. index it with per-cell levels (palette_lookup) to shade a
+    # whole console with a single console_fill_background.
+    cmap = color_gen_map(colors, indexes)
+    if numpy_available:
+        return numpy.array([color_pack(c) for c in cmap], dtype=numpy.intc)
+    return array('i', [color_pack(c) for c in cmap])
+
+def palette_lookup(palette, levels):
+    # (r, g, b) channels of palette[level] for every level.
+    if numpy_available and isinstance(palette, numpy.ndarray):
+        return colors_split(palette[numpy.asarray(levels, dtype=numpy.intp)])
+    return colors_split(array('i', [palette[k] for k in levels]))
+
 ############################
 # console module
 ############################
@@ -395,41 +588,69 @@ class Key(Structure):
               ('shift', c_bool),
               ]
 
+def _int_array_view(a):
+    # zero-copy c_int view of an array('i'), for handing it to libtcod
+    return (c_int * len(a)).from_buffer(a)
+
 class ConsoleBuffer:
     # simple console that allows direct (fast) access to cells. simplifies
-    # use of the "fill" functions.
-    def __init__(self, width, height, back_r=0, back_g=0, back_b=0, fore_r=0, fore_g=0, fore_b=0, char=' '):
+    # use of the "fill" functions. every channel is a persistent array('i')
+    # that blit passes to libtcod by pointer, so nothing is converted or
+    # copied. numpy.frombuffer(buffer.back_r, numpy.intc) gives a NumPy view.
+    #
+    # with track_dirty=True the set methods flag the cells they touch, and
+    # blit uploads only those cells when it is presenting to the same console
+    # as last time. that costs a libtcod call per cell while the fills cost a
+    # few calls for the whole console, so once more than full_fill_cells
+    # changed it falls back to the fills: on an 80x50 console the two break
+    # even at about 8 cells. changed_cells holds the count of the last blit.
+    # cells written behind its back (NumPy views, other drawing on the
+    # destination) need invalidate() so the next blit rewrites everything.
+    def __init__(self, width, height, back_r=0, back_g=0, back_b=0, fore_r=0, fore_g=0, fore_b=0, char=' ',
+                 track_dirty=False, full_fill_cells=8):
         # initialize with given width and height. values to fill the buffer
         # are optional, defaults to black with no characters.
-        n = width * height
         self.width = width
         self.height = height
+        self.track_dirty = track_dirty
+        self.full_fill_cells = full_fill_cells
+        self.changed_cells = 0
         self.clear(back_r, back_g, back_b, fore_r, fore_g, fore_b, char)
 
     def clear(self, back_r=0, back_g=0, back_b=0, fore_r=0, fore_g=0, fore_b=0, char=' '):
         # clears the console. values to fill it with are optional, defaults
         # to black with no characters.
         n = self.width * self.height
-        self.back_r = [back_r] * n
-        self.back_g = [back_g] * n
-        self.back_b = [back_b] * n
-        self.fore_r = [fore_r] * n
-        self.fore_g = [fore_g] * n
-        self.fore_b = [fore_b] * n
-        self.char = [ord(char)] * n
-    
+        self.back_r = array('i', [back_r]) * n
+        self.back_g = array('i', [back_g]) * n
+        self.back_b = array('i', [back_b]) * n
+        self.fore_r = array('i', [fore_r]) * n
+        self.fore_g = array('i', [fore_g]) * n
+        self.fore_b = array('i', [fore_b]) * n
+        self.char = array('i', [ord(char)]) * n
+        self.invalidate()
+
+    def invalidate(self):
+        # mark every cell dirty and forget the last destination, so the next
+        # blit is a full one.
+        self.dirty = bytearray(b'\x01') * (self.width * self.height)
+        self._last_blit = None
+
     def copy(self):
         # returns a copy of this ConsoleBuffer.
         other = ConsoleBuffer(0, 0)
         other.width = self.width
         other.height = self.height
-        other.back_r = list(self.back_r)  # make explicit copies of all lists
-        other.back_g = list(self.back_g)
-        other.back_b = list(self.back_b)
-        other.fore_r = list(self.fore_r)
-        other.fore_g = list(self.fore_g)
-        other.fore_b = list(self.fore_b)
-        other.char = list(self.char)
+        other.back_r = array('i', self.back_r)  # make explicit copies of all arrays
+        other.back_g = array('i', self.back_g)
+        other.back_b = array('i', self.back_b)
+        other.fore_r = array('i', self.fore_r)
+        other.fore_g = array('i', self.fore_g)
+        other.fore_b = array('i', self.fore_b)
+        other.char = array('i', self.char)
+        other.track_dirty = self.track_dirty
+        other.full_fill_cells = self.full_fill_cells
+        other.invalidate()  # the copy has never been blitted
         return other
     
     def set_fore(self, x, y, r, g, b, char):
@@ -439,6 +660,7 @@ class ConsoleBuffer:
         self.fore_g[i] = g
         self.fore_b[i] = b
         self.char[i] = ord(char)
+        self.dirty[i] = 1
     
     def set_back(self, x, y, r, g, b):
         # set the background color of one cell.
@@ -446,6 +668,7 @@ class ConsoleBuffer:
         self.back_r[i] = r
         self.back_g[i] = g
         self.back_b[i] = b
+        self.dirty[i] = 1
     
     def set(self, x, y, back_r, back_g, back_b, fore_r, fore_g, fore_b, char):
         # set the background color, foreground color and character of one cell.
@@ -457,32 +680,66 @@ class ConsoleBuffer:
         self.fore_g[i] = fore_g
         self.fore_b[i] = fore_b
         self.char[i] = ord(char)
+        self.dirty[i] = 1
     
     def blit(self, dest, fill_fore=True, fill_back=True):
         # use libtcod's "fill" functions to write the buffer to a console.
+        # returns the number of cells written.
         if (console_get_width(dest) != self.width or
             console_get_height(dest) != self.height):
             raise ValueError('ConsoleBuffer.blit: Destination console has an incorrect size.')
 
-        s = struct.Struct('%di' % len(self.back_r))
+        n = self.width * self.height
+        if self.track_dirty and self._last_blit == (dest, fill_fore, fill_back):
+            changed = self.dirty.count(b'\x01')
+            if changed <= self.full_fill_cells:
+                self._blit_dirty(dest, fill_fore, fill_back)
+                self.dirty = bytearray(n)
+                self.changed_cells = changed
+                return changed
+        self._last_blit = (dest, fill_fore, fill_back)
+        self.dirty = bytearray(n)
+        self.changed_cells = n
 
         if fill_back:
-            _lib.TCOD_console_fill_background(dest, (c_int * len(self.back_r))(*self.back_r), (c_int * len(self.back_g))(*self.back_g), (c_int * len(self.back_b))(*self.back_b))
+            _lib.TCOD_console_fill_background(dest, _int_array_view(self.back_r), _int_array_view(self.back_g), _int_array_view(self.back_b))
 
         if fill_fore:
-            _lib.TCOD_console_fill_foreground(dest, (c_int * len(self.fore_r))(*self.fore_r), (c_int * len(self.fore_g))(*self.fore_g), (c_int * len(self.fore_b))(*self.fore_b))
-            _lib.TCOD_console_fill_char(dest, (c_int * len(self.char))(*self.char))
-
-_lib.TCOD_console_credits_render.restype = c_bool
-_lib.TCOD_console_is_fullscreen.restype = c_bool
-_lib.TCOD_console_is_window_closed.restype = c_bool
-_lib.TCOD_console_get_default_background.restype = Color
-_lib.TCOD_console_get_default_foreground.restype = Color
-_lib.TCOD_console_get_char_background.restype = Color
-_lib.TCOD_console_get_char_foreground.restype = Color
-_lib.TCOD_console_get_fading_color.restype = Color
-_lib.TCOD_console_is_key_pressed.restype = c_bool
-
+            _lib.TCOD_console_fill_foreground(dest, _int_array_view(self.fore_r), _int_array_view(self.fore_g), _int_array_view(self.fore_b))
+            _lib.TCOD_console_fill_char(dest, _int_array_view(self.char))
+        return n
+
+    def _blit_dirty(self, dest, fill_fore, fill_back):
+        # write just the flagged cells, one libtcod call per cell and channel.
+        fore = Color()
+        back = Color()
+        dirty = self.dirty
+        w = self.width
+        i = dirty.find(b'\x01')
+        while i >= 0:
+            x, y = i % w, i // w
+            if fill_back:
+                back.r, back.g, back.b = self.back_r[i], self.back_g[i], self.back_b[i]
+            if fill_fore:
+                fore.r, fore.g, fore.b = self.fore_r[i], self.fore_g[i], self.fore_b[i]
+            if fill_fore and fill_back:
+                _lib.TCOD_console_put_char_ex(dest, x, y, self.char[i], fore, back)
+            elif fill_back:
+                _lib.TCOD_console_set_char_background(dest, x, y, back, BKGND_SET)
+            elif fill_fore:
+                _lib.TCOD_console_set_char_foreground(dest, x, y, fore)
+                _lib.TCOD_console_set_char(dest, x, y, self.char[i])
+            i = dirty.find(b'\x01', i + 1)
+
+_lib.declare('TCOD_console_credits_render', c_bool)
+_lib.declare('TCOD_console_is_fullscreen', c_bool)
+_lib.declare('TCOD_console_is_window_closed', c_bool)
+_lib.declare('TCOD_console_get_default_background', Color)
+_lib.declare('TCOD_console_get_default_foreground', Color)
+_lib.declare('TCOD_console_get_char_background', Color)
+_lib.declare('TCOD_console_get_char_foreground', Color)
+_lib.declare('TCOD_console_get_fading_color', Color)
+_lib.declare('TCOD_console_is_key_pressed', c_bool)
 # background rendering modes
 BKGND_NONE = 0
 BKGND_SET = 1
@@ -920,6 +1177,12 @@ def console_fill_foreground(con,r,g,b) :
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
+    elif (isinstance(r, array) and isinstance(g, array) and
+          isinstance(b, array) and r.typecode == g.typecode == b.typecode == 'i'):
+        # int arrays are passed by pointer, without a copy
+        cr = _int_array_view(r)
+        cg = _int_array_view(g)
+        cb = _int_array_view(b)
     else:
         # otherwise convert using ctypes arrays
         cr = (c_int * len(r))(*r)
@@ -941,6 +1204,12 @@ def console_fill_background(con,r,g,b) :
         cr = r.ctypes.data_as(POINTER(c_int))
         cg = g.ctypes.data_as(POINTER(c_int))
         cb = b.ctypes.data_as(POINTER(c_int))
+    elif (isinstance(r, array) and isinstance(g, array) and
+          isinstance(b, array) and r.typecode == g.typecode == b.typecode == 'i'):
+        # int arrays are passed by pointer, without a copy
+        cr = _int_array_view(r)
+        cg = _int_array_view(g)
+        cb = _int_array_view(b)
     else:
         # otherwise convert using ctypes arrays
         cr = (c_int * len(r))(*r)
@@ -954,6 +1223,9 @@ def console_fill_char(con,arr) :
         #numpy arrays, use numpy's ctypes functions
         arr = numpy.ascontiguousarray(arr, dtype=numpy.int_)
         carr = arr.ctypes.data_as(POINTER(c_int))
+    elif isinstance(arr, array) and arr.typecode == 'i':
+        # int arrays are passed by pointer, without a copy
+        carr = _int_array_view(arr)
     else:
         #otherwise convert using the struct module
         carr = struct.pack('%di' % len(arr), *arr)
@@ -972,9 +1244,8 @@ def console_save_apf(con, filename) :
 ############################
 # sys module
 ############################
-_lib.TCOD_sys_get_last_frame_length.restype = c_float
-_lib.TCOD_sys_elapsed_seconds.restype = c_float
-
+_lib.declare('TCOD_sys_get_last_frame_length', c_float)
+_lib.declare('TCOD_sys_elapsed_seconds', c_float)
 # high precision time functions
 def sys_set_fps(fps):
     _lib.TCOD_sys_set_fps(fps)
@@ -1049,10 +1320,9 @@ def sys_wait_for_event(mask,k,m,flush) :
 ############################
 # line module
 ############################
-_lib.TCOD_line_step.restype = c_bool
-_lib.TCOD_line.restype=c_bool
-_lib.TCOD_line_step_mt.restype = c_bool
-
+_lib.declare('TCOD_line_step', c_bool)
+_lib.declare('TCOD_line', c_bool)
+_lib.declare('TCOD_line_step_mt', c_bool)
 def line_init(xo, yo, xd, yd):
     _lib.TCOD_line_init(xo, yo, xd, yd)
 
@@ -1079,13 +1349,81 @@ def line_iter(xo, yo, xd, yd):
         yield x.value, y.value
         done = _lib.TCOD_line_step_mt(byref(x), byref(y), data)
 
+# bulk lines, computed in Python with the same steps as TCOD_line_step_mt,
+# so the cells match line_iter without a ctypes call per cell. the optional
+# blocked mask is a sequence of w * h values indexed x + y * w (a bytearray,
+# bytes, list or flat NumPy array). a line stops at the first cell whose mask
+# value is true, that cell included, or just before it would leave the mask.
+def _line_extend(xs, ys, xo, yo, xd, yd, blocked, w):
+    dx = xd - xo
+    dy = yd - yo
+    sx = (dx > 0) - (dx < 0)
+    sy = (dy > 0) - (dy < 0)
+    ax = sx * dx
+    ay = sy * dy
+    x, y = xo, yo
+    xs.append(x)
+    ys.append(y)
+    if blocked is not None:
+        size = len(blocked)
+    if ax > ay:
+        e = ax
+        while x != xd:
+            x += sx
+            e -= 2 * ay
+            if e < 0:
+                y += sy
+                e += 2 * ax
+            if blocked is not None:
+                i = x + y * w
+                if x < 0 or x >= w or i < 0 or i >= size:
+                    return
+            xs.append(x)
+            ys.append(y)
+            if blocked is not None and blocked[i]:
+                return
+    else:
+        e = ay
+        while y != yd:
+            y += sy
+            e -= 2 * ax
+            if e < 0:
+                x += sx
+                e += 2 * ay
+            if blocked is not None:
+                i = x + y * w
+                if x < 0 or x >= w or i < 0 or i >= size:
+                    return
+            xs.append(x)
+            ys.append(y)
+            if blocked is not None and blocked[i]:
+                return
+
+def line_cells(xo, yo, xd, yd, blocked=None, w=0):
+    # cells from (xo, yo) to (xd, yd), both included, as a list of (x, y).
+    xs = array('i')
+    ys = array('i')
+    _line_extend(xs, ys, xo, yo, xd, yd, blocked, w)
+    return list(zip(xs, ys))
+
+def lines_cells(lines, blocked=None, w=0):
+    # trace many (xo, yo, xd, yd) lines at once. returns three array('i'):
+    # xs and ys hold the cells of every line back to back, and line k is
+    # xs[starts[k]:starts[k + 1]], ys[starts[k]:starts[k + 1]].
+    xs = array('i')
+    ys = array('i')
+    starts = array('i', [0])
+    for xo, yo, xd, yd in lines:
+        _line_extend(xs, ys, xo, yo, xd, yd, blocked, w)
+        starts.append(len(xs))
+    return xs, ys, starts
+
 ############################
 # image module
 ############################
-_lib.TCOD_image_is_pixel_transparent.restype = c_bool
-_lib.TCOD_image_get_pixel.restype = Color
-_lib.TCOD_image_get_mipmap_pixel.restype = Color
-
+_lib.declare('TCOD_image_is_pixel_transparent', c_bool)
+_lib.declare('TCOD_image_get_pixel', Color)
+_lib.declare('TCOD_image_get_mipmap_pixel', Color)
 def image_new(width, height):
     return _lib.TCOD_image_new(width, height)
 
@@ -1141,6 +1479,100 @@ def image_put_pixel(image, x, y, col):
     _lib.TCOD_image_put_pixel(image, x, y, col)
     ##_lib.TCOD_image_put_pixel_wrapper(image, x, y, col)
 
+# bulk pixel access. pixels move as packed RGB planes, row after row: a
+# (h, w, 3) uint8 NumPy array, or bytes/bytearray of w * h * 3 values.
+# libtcod keeps the full size image as exactly that, a TCOD_color_t array
+# (mipmap 0), so both directions are a single memory copy through the
+# image's private struct, mirrored below from libtcod 1.5.1. if the struct
+# doesn't check out against get_size/get_pixel, or a read finds no mipmaps
+# yet, they fall back to one get/put_pixel call per pixel.
+class _CMipmap(Structure):
+    _fields_=[('width', c_int),
+              ('height', c_int),
+              ('fwidth', c_float),
+              ('fheight', c_float),
+              ('buf', POINTER(Color)),
+              ('dirty', c_bool),
+              ]
+
+class _CImage(Structure):
+    _fields_=[('sys_img', c_void_p),
+              ('nb_mipmaps', c_int),
+              ('mipmaps', POINTER(_CMipmap)),
+              ('key_color', Color),
+              ('has_key_color', c_bool),
+              ]
+
+def _image_mipmaps(image, w, h, create):
+    # the image's mipmap array, or None if the layout doesn't match. images
+    # loaded from a file or a console only build their mipmaps on the first
+    # put_pixel; with create, one pixel is written back onto itself first.
+    # a reader must not do that: from then on libtcod reads the image from
+    # mipmap 0, which image_refresh_console never updates.
+    if w <= 0 or h <= 0:
+        return None
+    img = cast(image, POINTER(_CImage)).contents
+    if not img.mipmaps:
+        if not create:
+            return None
+        image_put_pixel(image, 0, 0, image_get_pixel(image, 0, 0))
+    if not img.mipmaps or img.nb_mipmaps < 1:
+        return None
+    base = img.mipmaps[0]
+    if base.width != w or base.height != h or not base.buf:
+        return None
+    last = base.buf[w * h - 1]
+    col = image_get_pixel(image, w - 1, h - 1)
+    if (last.r, last.g, last.b) != (col.r, col.g, col.b):
+        return None
+    return img
+
+def image_get_pixels(image):
+    w, h = image_get_size(image)
+    img = _image_mipmaps(image, w, h, False)
+    if img is not None:
+        out = bytearray(string_at(img.mipmaps[0].buf, w * h * 3))
+    else:
+        out = bytearray(w * h * 3)
+        get = _lib.TCOD_image_get_pixel
+        i = 0
+        for y in range(h):
+            for x in range(w):
+                col = get(image, x, y)
+                out[i] = col.r
+                out[i + 1] = col.g
+                out[i + 2] = col.b
+                i += 3
+    if numpy_available:
+        return numpy.frombuffer(out, dtype=numpy.uint8).reshape(h, w, 3)
+    return out
+
+def image_put_pixels(image, pixels):
+    w, h = image_get_size(image)
+    if numpy_available and isinstance(pixels, numpy.ndarray):
+        pixels = bytearray(numpy.ascontiguousarray(pixels, dtype=numpy.uint8).data)
+    elif not isinstance(pixels, bytearray):
+        pixels = bytearray(pixels)
+    if len(pixels) != w * h * 3:
+        raise ValueError('image_put_pixels: expected %d RGB values, got %d.' % (w * h * 3, len(pixels)))
+    img = _image_mipmaps(image, w, h, True)
+    if img is not None:
+        memmove(img.mipmaps[0].buf, (c_ubyte * len(pixels)).from_buffer(pixels), len(pixels))
+        # the smaller mipmaps are rebuilt from it when next needed
+        for i in range(1, img.nb_mipmaps):
+            img.mipmaps[i].dirty = True
+        return
+    put = _lib.TCOD_image_put_pixel
+    col = Color()
+    i = 0
+    for y in range(h):
+        for x in range(w):
+            col.r = pixels[i]
+            col.g = pixels[i + 1]
+            col.b = pixels[i + 2]
+            put(image, x, y, col)
+            i += 3
+
 def image_blit(image, console, x, y, bkgnd_flag, scalex, scaley, angle):
     _lib.TCOD_image_blit(image, console, c_float(x), c_float(y), bkgnd_flag,
                          c_float(scalex), c_float(scaley), c_float(angle))
@@ -1179,8 +1611,7 @@ class Mouse(Structure):
               ('wheel_down', c_bool),
               ]
 
-_lib.TCOD_mouse_is_cursor_visible.restype = c_bool
-
+_lib.declare('TCOD_mouse_is_cursor_visible', c_bool)
 def mouse_show_cursor(visible):
     _lib.TCOD_mouse_show_cursor(c_int(visible))
 
@@ -1198,13 +1629,12 @@ def mouse_get_status():
 ############################
 # parser module
 ############################
-_lib.TCOD_struct_get_name.restype = c_char_p
-_lib.TCOD_struct_is_mandatory.restype = c_bool
-_lib.TCOD_parser_get_bool_property.restype = c_bool
-_lib.TCOD_parser_get_float_property.restype = c_float
-_lib.TCOD_parser_get_string_property.restype = c_char_p
-_lib.TCOD_parser_get_color_property.restype = Color
-
+_lib.declare('TCOD_struct_get_name', c_char_p)
+_lib.declare('TCOD_struct_is_mandatory', c_bool)
+_lib.declare('TCOD_parser_get_bool_property', c_bool)
+_lib.declare('TCOD_parser_get_float_property', c_float)
+_lib.declare('TCOD_parser_get_string_property', c_char_p)
+_lib.declare('TCOD_parser_get_color_property', Color)
 class Dice(Structure):
     _fields_=[('nb_dices', c_int),
               ('nb_faces', c_int),
@@ -1292,8 +1722,14 @@ def _convert_TCODList(clist, typ):
 def parser_new():
     return _lib.TCOD_parser_new()
 
+# struct handles by name for every parser, so parser_run_cached can hand a
+# listener the right struct when it replays a cached file
+_parser_structs = {}
+
 def parser_new_struct(parser, name):
-    return _lib.TCOD_parser_new_struct(parser, name)
+    struct = _lib.TCOD_parser_new_struct(parser, name)
+    _parser_structs.setdefault(parser, {})[name] = struct
+    return struct
 
 def struct_add_flag(struct, name):
     _lib.TCOD_struct_add_flag(struct, name)
@@ -1358,7 +1794,132 @@ def parser_run(parser, filename, listener=0):
     else:
         _lib.TCOD_parser_run(parser, c_char_p(filename), 0)
 
+# parse-once cache. parser_run_cached runs the parser the first time with a
+# recording listener and marshals the listener events to a cache file (by
+# default filename + '.cache'), keyed by the file's mtime, size and sha1. on
+# later runs, if the file is unchanged, the events are replayed straight to
+# the listener without calling the parser: one read of the cache file. if
+# only the mtime moved, the sha1 decides and the cache is refreshed. bump
+# version when the parser's structs change, since that changes what the same
+# file parses to. files that report errors are never cached. the default
+# listener (listener=0) fills the parser itself, so it is not cached.
+_PARSER_CACHE_MAGIC = 'TCODPARSE1'
+
+class _ParserRecorder(object):
+    def __init__(self, listener):
+        self.listener = listener
+        self.events = []
+        self.failed = False
+
+    def new_struct(self, struct, name):
+        self.events.append(('s', _lib.TCOD_struct_get_name(struct), name))
+        return self.listener.new_struct(struct, name)
+
+    def new_flag(self, name):
+        self.events.append(('f', name))
+        return self.listener.new_flag(name)
+
+    def new_property(self, name, typ, value):
+        self.events.append(('p', name, typ, _parser_value_dump(typ, value)))
+        return self.listener.new_property(name, typ, value)
+
+    def end_struct(self, struct, name):
+        self.events.append(('e', _lib.TCOD_struct_get_name(struct), name))
+        return self.listener.end_struct(struct, name)
+
+    def error(self, msg):
+        self.failed = True
+        return self.listener.error(msg)
+
+def _parser_value_dump(typ, value):
+    # plain marshalable form of a property value
+    if typ & TYPE_LIST:
+        return [_parser_value_dump(typ & 0xFF, v) for v in value]
+    if typ == TYPE_COLOR:
+        return (value.r, value.g, value.b)
+    if typ == TYPE_DICE:
+        return (value.nb_dices, value.nb_faces, value.multiplier, value.addsub)
+    return value
+
+def _parser_value_load(typ, value):
+    if typ & TYPE_LIST:
+        return [_parser_value_load(typ & 0xFF, v) for v in value]
+    if typ == TYPE_COLOR:
+        return Color(*value)
+    if typ == TYPE_DICE:
+        return Dice(*value)
+    return value
+
+def _parser_cache_read(cache_file):
+    try:
+        f = open(cache_file, 'rb')
+        try:
+            data = marshal.load(f)
+        finally:
+            f.close()
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+    if (not isinstance(data, tuple) or len(data) != 6 or
+        data[0] != _PARSER_CACHE_MAGIC):
+        return None
+    return data
+
+def _parser_cache_write(cache_file, data):
+    try:
+        f = open(cache_file, 'wb')
+        try:
+            marshal.dump(data, f)
+        finally:
+            f.close()
+    except (IOError, OSError):
+        pass  # caching is best effort
+
+def parser_run_cached(parser, filename, listener=0, cache_file=None, version=0):
+    if listener == 0:
+        return parser_run(parser, filename)
+    if cache_file is None:
+        cache_file = filename + '.cache'
+    st = os.stat(filename)
+    cached = _parser_cache_read(cache_file)
+    if cached is not None and cached[1] != version:
+        cached = None
+    if cached is not None and not (cached[2] == st.st_mtime and cached[3] == st.st_size):
+        f = open(filename, 'rb')
+        try:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        finally:
+            f.close()
+        if cached[4] == digest:
+            cached = (_PARSER_CACHE_MAGIC, version, st.st_mtime, st.st_size, digest, cached[5])
+            _parser_cache_write(cache_file, cached)
+        else:
+            cached = None
+    if cached is not None:
+        structs = _parser_structs.get(parser, {})
+        for event in cached[5]:
+            kind = event[0]
+            if kind == 'p':
+                listener.new_property(event[1], event[2], _parser_value_load(event[2], event[3]))
+            elif kind == 'f':
+                listener.new_flag(event[1])
+            elif kind == 's':
+                listener.new_struct(structs.get(event[1]), event[2])
+            else:
+                listener.end_struct(structs.get(event[1]), event[2])
+        return
+    f = open(filename, 'rb')
+    try:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    finally:
+        f.close()
+    recorder = _ParserRecorder(listener)
+    parser_run(parser, filename, recorder)
+    if not recorder.failed:
+        _parser_cache_write(cache_file, (_PARSER_CACHE_MAGIC, version, st.st_mtime,
+                                         st.st_size, digest, recorder.events))
+
 def parser_delete(parser):
+    _parser_structs.pop(parser, None)
     _lib.TCOD_parser_delete(parser)
 
 def parser_get_bool_property(parser, name):
@@ -1391,9 +1952,8 @@ def parser_get_list_property(parser, name, typ):
 ############################
 # random module
 ############################
-_lib.TCOD_random_get_float.restype = c_float
-_lib.TCOD_random_get_double.restype = c_double
-
+_lib.declare('TCOD_random_get_float', c_float)
+_lib.declare('TCOD_random_get_double', c_double)
 RNG_MT = 0
 RNG_CMWC = 1
 
@@ -1445,13 +2005,12 @@ def random_delete(rnd):
 ############################
 # noise module
 ############################
-_lib.TCOD_noise_get.restype = c_float
-_lib.TCOD_noise_get_ex.restype = c_float
-_lib.TCOD_noise_get_fbm.restype = c_float
-_lib.TCOD_noise_get_fbm_ex.restype = c_float
-_lib.TCOD_noise_get_turbulence.restype = c_float
-_lib.TCOD_noise_get_turbulence_ex.restype = c_float
-
+_lib.declare('TCOD_noise_get', c_float)
+_lib.declare('TCOD_noise_get_ex', c_float)
+_lib.declare('TCOD_noise_get_fbm', c_float)
+_lib.declare('TCOD_noise_get_fbm_ex', c_float)
+_lib.declare('TCOD_noise_get_turbulence', c_float)
+_lib.declare('TCOD_noise_get_turbulence_ex', c_float)
 NOISE_DEFAULT_HURST = 0.5
 NOISE_DEFAULT_LACUNARITY = 2.0
 
@@ -1482,16 +2041,61 @@ def noise_get_fbm(n, f, oc, typ=NOISE_DEFAULT):
 def noise_get_turbulence(n, f, oc, typ=NOISE_DEFAULT):
     return _lib.TCOD_noise_get_turbulence_ex(n, _NOISE_PACKER_FUNC[len(f)](*f), c_float(oc), typ)
 
+def noise_get_grid(n, w, h, x=0.0, y=0.0, scale=1.0, oc=0, typ=NOISE_DEFAULT,
+                   turbulence=False, z=None):
+    # sample a w*h grid in one go. cell (i, j) is sampled at
+    # (x + i * scale, y + j * scale), or at (..., z) to take a slice of a 3D
+    # noise. oc=0 gives plain noise, otherwise fbm (or turbulence) with oc
+    # octaves. returns a (h, w) float32 NumPy array if NumPy is available,
+    # otherwise an array('f') of w*h values indexed x + y * w.
+    if (oc > 0 and not turbulence and z is None and typ == NOISE_DEFAULT and
+        scale != 0 and w > 0 and h > 0):
+        # 2D fbm is exactly what heightmap_add_fbm computes, natively:
+        # f = ((i + addx) * mulx / w, (j + addy) * muly / h)
+        hm = heightmap_new(w, h)
+        heightmap_add_fbm(hm, n, scale * w, scale * h, x / float(scale),
+                          y / float(scale), oc, 0.0, 1.0)
+        values = heightmap_get_values(hm)
+        if numpy_available:
+            grid = values.copy()
+        else:
+            grid = array('f', string_at(addressof(values), w * h * sizeof(c_float)))
+        heightmap_delete(hm)
+        return grid
+    grid = array('f', [0.0]) * (w * h)
+    if z is None:
+        f = _NOISE_PACKER_FUNC[2]()
+    else:
+        f = _NOISE_PACKER_FUNC[3](0.0, 0.0, z)
+    if oc <= 0:
+        sample = lambda: _lib.TCOD_noise_get_ex(n, f, typ)
+    else:
+        coc = c_float(oc)
+        if turbulence:
+            get = _lib.TCOD_noise_get_turbulence_ex
+        else:
+            get = _lib.TCOD_noise_get_fbm_ex
+        sample = lambda: get(n, f, coc, typ)
+    i = 0
+    for j in range(h):
+        f[1] = y + j * scale
+        for k in range(w):
+            f[0] = x + k * scale
+            grid[i] = sample()
+            i += 1
+    if numpy_available:
+        return numpy.frombuffer(grid, dtype=numpy.float32).reshape(h, w)
+    return grid
+
 def noise_delete(n):
     _lib.TCOD_noise_delete(n)
 
 ############################
 # fov module
 ############################
-_lib.TCOD_map_is_in_fov.restype = c_bool
-_lib.TCOD_map_is_transparent.restype = c_bool
-_lib.TCOD_map_is_walkable.restype = c_bool
-
+_lib.declare('TCOD_map_is_in_fov', c_bool)
+_lib.declare('TCOD_map_is_transparent', c_bool)
+_lib.declare('TCOD_map_is_walkable', c_bool)
 FOV_BASIC = 0
 FOV_DIAMOND = 1
 FOV_SHADOW = 2
@@ -1546,10 +2150,9 @@ def map_get_height(map):
 ############################
 # pathfinding module
 ############################
-_lib.TCOD_path_compute.restype = c_bool
-_lib.TCOD_path_is_empty.restype = c_bool
-_lib.TCOD_path_walk.restype = c_bool
-
+_lib.declare('TCOD_path_compute', c_bool)
+_lib.declare('TCOD_path_is_empty', c_bool)
+_lib.declare('TCOD_path_walk', c_bool)
 PATH_CBK_FUNC = CFUNCTYPE(c_float, c_int, c_int, c_int, c_int, py_object)
 
 def path_new_using_map(m, dcost=1.41):
@@ -1600,11 +2203,10 @@ def path_walk(p, recompute):
 def path_delete(p):
     _lib.TCOD_path_delete(p[0])
 
-_lib.TCOD_dijkstra_path_set.restype = c_bool
-_lib.TCOD_dijkstra_is_empty.restype = c_bool
-_lib.TCOD_dijkstra_path_walk.restype = c_bool
-_lib.TCOD_dijkstra_get_distance.restype = c_float
-
+_lib.declare('TCOD_dijkstra_path_set', c_bool)
+_lib.declare('TCOD_dijkstra_is_empty', c_bool)
+_lib.declare('TCOD_dijkstra_path_walk', c_bool)
+_lib.declare('TCOD_dijkstra_get_distance', c_float)
 def dijkstra_new(m, dcost=1.41):
     return (_lib.TCOD_dijkstra_new(c_void_p(m), c_float(dcost)), None)
 
@@ -1647,6 +2249,196 @@ def dijkstra_path_walk(p):
 def dijkstra_delete(p):
     _lib.TCOD_dijkstra_delete(p[0])
 
+# cost map pathfinding. instead of calling back into python for every edge
+# (path_new_using_function), these take a precomputed per-cell cost array :
+# a list, array, bytes/bytearray or NumPy array of w*h values indexed
+# x + y * w (a (h, w) NumPy array works as is). 0 means blocked, any other
+# value is the cost of entering the cell, multiplied by dcost on diagonals.
+# libtcod 1.5.1 has no native entry point for cost arrays, so the search
+# runs here over flat arrays without crossing into the library at all.
+_COST_NEIGHBOURS = ((-1, -1, True), (0, -1, False), (1, -1, True),
+                    (-1, 0, False), (1, 0, False),
+                    (-1, 1, True), (0, 1, False), (1, 1, True))
+_COST_INF = float('inf')
+
+def _costs_as_sequence(costs, w, h):
+    if numpy_available and isinstance(costs, numpy.ndarray):
+        costs = costs.ravel().tolist()
+    elif isinstance(costs, bytes):
+        # python 2 strings index as characters
+        costs = bytearray(costs)
+    if len(costs) != w * h:
+        raise ValueError('Cost array must have exactly w * h values.')
+    return costs
+
+def _cost_search(costs, w, h, seeds, dcost):
+    # dijkstra from a list of (index, value) seeds over the whole map.
+    # returns the distance and parent lists.
+    n = w * h
+    dist = [_COST_INF] * n
+    parent = [-1] * n
+    closed = bytearray(n)
+    heap = []
+    for i, value in seeds:
+        if value < dist[i]:
+            dist[i] = value
+            parent[i] = -1
+            heappush(heap, (value, i))
+    while heap:
+        d, i = heappop(heap)
+        if closed[i]:
+            continue
+        closed[i] = 1
+        x = i % w
+        y = i // w
+        for ox, oy, diagonal in _COST_NEIGHBOURS:
+            nx = x + ox
+            ny = y + oy
+            if nx < 0 or ny < 0 or nx >= w or ny >= h:
+                continue
+            j = nx + ny * w
+            c = costs[j]
+            if c <= 0 or closed[j]:
+                continue
+            if diagonal:
+                c *= dcost
+            nd = d + c
+            if nd < dist[j]:
+                dist[j] = nd
+                parent[j] = i
+                heappush(heap, (nd, j))
+    return dist, parent
+
+def _cost_astar(costs, w, h, origin, dest, dcost, mincost, bounds):
+    # A* from origin to dest (both indices). the search state lives in dicts,
+    # so a short path only pays for the cells it actually visits. returns the
+    # parent dict, or None if dest cannot be reached.
+    x0, y0, x1, y1 = bounds
+    dx = dest % w
+    dy = dest // w
+    # each step closes at most one cell of chebyshev distance and costs at
+    # least mincost * min(dcost, 1); with dcost >= 1 the octile distance is
+    # a tighter bound that is still admissible
+    straight = float(mincost)
+    if dcost >= 1.0:
+        diag = min(dcost, 2.0) - 1.0
+    else:
+        straight *= dcost
+        diag = 0.0
+    dist = {origin: 0.0}
+    parent = {origin: -1}
+    closed = set()
+    # ties on the estimate go to the cell furthest along (-d sorts first), so
+    # open ground is crossed along one line instead of filling the whole
+    # diamond of equally good cells
+    heap = [(0.0, 0.0, origin)]
+    while heap:
+        prio, d, i = heappop(heap)
+        d = -d
+        if i in closed:
+            continue
+        if i == dest:
+            return parent
+        closed.add(i)
+        x = i % w
+        y = i // w
+        for ox, oy, diagonal in _COST_NEIGHBOURS:
+            nx = x + ox
+            ny = y + oy
+            if nx < x0 or ny < y0 or nx > x1 or ny > y1:
+                continue
+            j = nx + ny * w
+            c = costs[j]
+            if c <= 0 or j in closed:
+                continue
+            if diagonal:
+                c *= dcost
+            nd = d + c
+            if nd < dist.get(j, _COST_INF):
+                dist[j] = nd
+                parent[j] = i
+                ax = abs(dx - nx)
+                ay = abs(dy - ny)
+                heappush(heap, (nd + straight * (max(ax, ay) + diag * min(ax, ay)), -nd, j))
+    return None
+
+def path_compute_using_costs(costs, w, h, ox, oy, dx, dy, dcost=1.41,
+                             mincost=None, bounds=None):
+    # A* from origin to destination. returns the whole path as a list of
+    # (x, y), origin excluded and destination included, or [] if there is none.
+    # mincost is the cheapest non-zero cost in the array; it scales the
+    # heuristic, and passing it saves a scan of the whole array per call.
+    # bounds (x0, y0, x1, y1), inclusive, keeps the search inside a box.
+    costs = _costs_as_sequence(costs, w, h)
+    if (ox, oy) == (dx, dy):
+        return []
+    if mincost is None:
+        positive = [c for c in costs if c > 0]
+        mincost = positive and min(positive) or 1
+    if bounds is None:
+        bounds = (0, 0, w - 1, h - 1)
+    else:
+        bounds = (max(0, bounds[0]), max(0, bounds[1]),
+                  min(w - 1, bounds[2]), min(h - 1, bounds[3]))
+    parent = _cost_astar(costs, w, h, ox + oy * w, dx + dy * w, dcost,
+                         mincost, bounds)
+    if parent is None:
+        return []
+    i = dx + dy * w
+    path = []
+    while parent[i] >= 0:
+        path.append((i % w, i // w))
+        i = parent[i]
+    path.reverse()
+    return path
+
+def dijkstra_compute_using_costs(costs, w, h, ox, oy, dcost=1.41):
+    # distance from the root to every cell, as an array('f') indexed
+    # x + y * w. unreachable cells are -1.0, like dijkstra_get_distance.
+    costs = _costs_as_sequence(costs, w, h)
+    dist, parent = _cost_search(costs, w, h, [(ox + oy * w, 0.0)], dcost)
+    return array('f', [d if d != _COST_INF else -1.0 for d in dist])
+
+def dijkstra_fill_using_costs(costs, w, h, goals, dcost=1.41):
+    # multi-goal distance field ("dijkstra map") in a single pass. goals are
+    # (x, y) cells at distance 0 or (x, y, value) cells with a starting value,
+    # which may be negative. unreachable cells are +inf rather than -1.0 so
+    # negative fields stay unambiguous.
+    costs = _costs_as_sequence(costs, w, h)
+    seeds = []
+    for goal in goals:
+        if len(goal) == 2:
+            seeds.append((goal[0] + goal[1] * w, 0.0))
+        else:
+            seeds.append((goal[0] + goal[1] * w, float(goal[2])))
+    dist, parent = _cost_search(costs, w, h, seeds, dcost)
+    return array('f', dist)
+
+def dijkstra_path_using_costs(dist, w, h, x, y):
+    # walk downhill on a distance array from (x, y) to the root. returns
+    # the cells to step through, (x, y) excluded and the root included.
+    i = x + y * w
+    if dist[i] < 0:
+        return []
+    path = []
+    for step in range(w * h):
+        best = i
+        for ox, oy, diagonal in _COST_NEIGHBOURS:
+            nx = x + ox
+            ny = y + oy
+            if nx < 0 or ny < 0 or nx >= w or ny >= h:
+                continue
+            j = nx + ny * w
+            if 0 <= dist[j] < dist[best]:
+                best = j
+        if best == i:
+            break
+        i = best
+        x = i % w
+        y = i // w
+        path.append((x, y))
+    return path
+
 ############################
 # bsp module
 ############################
@@ -1663,14 +2455,13 @@ class _CBsp(Structure):
                 ('horizontal', c_bool),
                 ]
 
-_lib.TCOD_bsp_new_with_size.restype = POINTER(_CBsp)
-_lib.TCOD_bsp_left.restype = POINTER(_CBsp)
-_lib.TCOD_bsp_right.restype = POINTER(_CBsp)
-_lib.TCOD_bsp_father.restype = POINTER(_CBsp)
-_lib.TCOD_bsp_is_leaf.restype = c_bool
-_lib.TCOD_bsp_contains.restype = c_bool
-_lib.TCOD_bsp_find_node.restype = POINTER(_CBsp)
-
+_lib.declare('TCOD_bsp_new_with_size', POINTER(_CBsp))
+_lib.declare('TCOD_bsp_left', POINTER(_CBsp))
+_lib.declare('TCOD_bsp_right', POINTER(_CBsp))
+_lib.declare('TCOD_bsp_father', POINTER(_CBsp))
+_lib.declare('TCOD_bsp_is_leaf', c_bool)
+_lib.declare('TCOD_bsp_contains', c_bool)
+_lib.declare('TCOD_bsp_find_node', POINTER(_CBsp))
 BSP_CBK_FUNC = CFUNCTYPE(c_int, c_void_p, c_void_p)
 
 # python class encapsulating the _CBsp pointer
@@ -1794,10 +2585,9 @@ class _CHeightMap(Structure):
               ('values', POINTER(c_float)),
               ]
 
-_lib.TCOD_heightmap_new.restype = POINTER(_CHeightMap)
-_lib.TCOD_heightmap_get_value.restype = c_float
-_lib.TCOD_heightmap_has_land_on_border.restype = c_bool
-
+_lib.declare('TCOD_heightmap_new', POINTER(_CHeightMap))
+_lib.declare('TCOD_heightmap_get_value', c_float)
+_lib.declare('TCOD_heightmap_has_land_on_border', c_bool)
 class HeightMap(object):
     def __init__(self, chm):
         pchm = cast(chm, POINTER(_CHeightMap))
@@ -1925,6 +2715,18 @@ def heightmap_get_minmax(hm):
     _lib.TCOD_heightmap_get_minmax(hm.p, byref(mi), byref(ma))
     return mi.value, ma.value
 
+def heightmap_get_values(hm):
+    # zero-copy view of the heightmap's float buffer, indexed [y][x] (or
+    # [y, x] with NumPy). a NumPy array of shape (h, w) if NumPy is available,
+    # otherwise a ctypes (c_float * w) * h array, which also supports
+    # memoryview(). writes through the view change the heightmap itself, so
+    # bulk math can be mixed freely with the heightmap_* functions. the view
+    # must not be used after heightmap_delete.
+    c = hm.p.contents
+    if numpy_available:
+        return numpy.ctypeslib.as_array(c.values, shape=(c.h, c.w))
+    return ((c_float * c.w) * c.h).from_address(addressof(c.values.contents))
+
 def heightmap_delete(hm):
     _lib.TCOD_heightmap_delete(hm.p)
 
@@ -1932,9 +2734,8 @@ def heightmap_delete(hm):
 ############################
 # name generator module
 ############################
-_lib.TCOD_namegen_generate.restype = c_char_p
-_lib.TCOD_namegen_generate_custom.restype = c_char_p
-
+_lib.declare('TCOD_namegen_generate', c_char_p)
+_lib.declare('TCOD_namegen_generate_custom', c_char_p)
 def namegen_parse(filename,random=0) :
     _lib.TCOD_namegen_parse(filename,random)
 
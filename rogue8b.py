@@ -1,6 +1,19 @@
 import libtcodpy as libtcod
 import math
 import textwrap
+import collections
+import heapq
+import bisect
+import time
+import timeit
+import sys
+import os
+import cProfile
+import pstats
+import struct
+import ctypes
+import threading
+import Queue
 
 #############################################
 # Constants
@@ -22,6 +35,20 @@ ROOM_MAX_SIZE = 10
 ROOM_MIN_SIZE = 6
 MAX_ROOMS = 30
 
+# room graph - tunnels are cut into regions no bigger than a sector, and
+# along a long wall two regions share there is a door every DOOR_SPACING cells
+REGION_SECTOR = 16
+DOOR_SPACING = 2
+#paths up to this long try one A* in a box around both ends (plus the margin)
+#before planning over the room graph
+DIRECT_PATH_DISTANCE = 16
+DIRECT_PATH_MARGIN = 4
+#cells on either side of a door that are planned again once a route is walked
+DOOR_WINDOW = 4
+#tunnels bend, so the straight line distance between doors falls well short of
+#the walk; weighting it a little keeps a route from searching half the level
+ROUTE_HEURISTIC_WEIGHT = 1.1
+
 # monster generation parameters
 MAX_ROOM_MONSTERS = 3
 
@@ -33,6 +60,14 @@ FOV_ALGO = 0 #use the default FOV algorithm
 FOV_LIGHT_WALLS = True
 TORCH_RADIUS = 10
 
+# monster FOV cache - caps the memory used by cached visibility masks
+FOV_CACHE_MAX_BYTES = 256 * 1024
+
+# dijkstra maps - flee maps scale the approach map by this, then let it settle
+FLEE_COEFFICIENT = -1.2
+#how strongly fleeing monsters are drawn to items on the floor
+COWARD_GREED = 0.3
+
 # Status Bar constants
 # This will cause this to appear to the right of the health bar
 # and fill up the rest of the space.
@@ -45,12 +80,44 @@ MSG_X = BAR_WIDTH + 2
 MSG_WIDTH = SCREEN_WIDTH - BAR_WIDTH - 2
 MSG_HEIGHT = PANEL_HEIGHT - 1
 
+# full message history kept for the scrollback viewer
+MSG_HISTORY = 5000
+
+# how many (text, width) wrappings to remember
+WRAP_CACHE_SIZE = 512
+
+# spare offscreen consoles kept for reuse by menus and popups
+MAX_FREE_CONSOLES = 8
+
+# frame timing - how many recent frames the rolling stats cover, and the overlay size
+FRAME_STATS_WINDOW = 200
+FRAME_OVERLAY_WIDTH = 40
+FRAME_OVERLAY_HEIGHT = 16
+
 #Inventory menu width
 INVENTORY_WIDTH = 50
 
 #potion constant
 HEAL_AMOUNT = 4
 
+# monster and item spawn tables, parsed once and then read from a cache next
+# to the file; bump the version when the structs in load_spawn_tables change
+SPAWN_DATA = 'spawns.cfg'
+SPAWN_DATA_VERSION = 1
+
+# save game file, written on exit and resumed at startup (unless --new)
+SAVE_FILE = 'savegame.sav'
+SAVE_MAGIC = 'RL8S'
+SAVE_VERSION = 1
+
+# bytes in libtcod 1.5.1's random generator state (mersenne_data_t)
+RNG_STATE_SIZE = 18900
+
+# autosave - where it goes, how many turns apart, and the map rows per tile chunk
+AUTOSAVE_DIR = 'autosave'
+AUTOSAVE_TURNS = 5
+AUTOSAVE_ROWS = 8
+
 #############################################
 # Map class and color definitions
 #############################################
@@ -131,8 +198,11 @@ class Object:
     def move(self, dx, dy): 
         # checks to permit movement if no blocked tiles ahead.
         if not is_blocked(self.x + dx, self.y + dy):
+            touch_cell(self.x, self.y)
             self.x += dx
             self.y += dy
+            touch_cell(self.x, self.y)
+            autosave.touch_entity(self)
 
     # movement AI - basically, "if you see a player, chase him"
     def move_towards(self, target_x, target_y):
@@ -146,6 +216,35 @@ class Object:
         dx = int(round(dx / distance))
         dy = int(round(dy / distance))
         self.move(dx, dy)
+        
+    #step along a path to the target, which goes round walls instead of into them
+    def path_towards(self, target_x, target_y):
+        path = hierarchical_path(self.x, self.y, target_x, target_y)
+        if path and not is_blocked(path[0][0], path[0][1]):
+            self.move(path[0][0] - self.x, path[0][1] - self.y)
+        else:
+            #no way through, or someone is standing in it: head straight for it
+            self.move_towards(target_x, target_y)
+    
+    #step to the neighbouring tile with the lowest value on a dijkstra map
+    #returns False if no free neighbour is lower than where we stand
+    def move_downhill(self, field):
+        best_value = field[self.x + self.y * MAP_WIDTH]
+        best = None
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                x = self.x + dx
+                y = self.y + dy
+                if x < 0 or y < 0 or x >= MAP_WIDTH or y >= MAP_HEIGHT:
+                    continue
+                value = field[x + y * MAP_WIDTH]
+                if value < best_value and not is_blocked(x, y):
+                    best_value = value
+                    best = (dx, dy)
+        if best is None:
+            return False
+        self.move(best[0], best[1])
+        return True
     
     #return the distance to another object, handy for a variety of things
     def distance_to(self, other):
@@ -168,6 +267,7 @@ class Object:
         global objects
         objects.remove(self)
         objects.insert(0, self)
+        touch_cell(self.x, self.y) #the order of names at this cell changed
 
 class Fighter:
     # combat statistics for monsters, players, and NPCs
@@ -183,6 +283,7 @@ class Fighter:
         #if there's any damage to apply do it
         if damage > 0:
             self.hp -= damage
+            autosave.touch_entity(self.owner)
             
             if self.hp <= 0:
                 function = self.death_function
@@ -196,53 +297,69 @@ class Fighter:
         if damage > 0:
             choice = libtcod.random_get_int(0, 0, 100)
             if choice < 20:
-                message(self.owner.name.capitalize() + ' attacks ' + target.name + ' for ' + str(damage) + ' hit points.', libtcod.light_grey)
+                message('%s attacks %s for %d hit points.', libtcod.light_grey, self.owner.name.capitalize(), target.name, damage)
                 target.fighter.take_damage(damage)
             elif choice < 20+20:
-                message(self.owner.name.capitalize() + ' swings ' + target.name + ' for ' + str(damage) + ' hit points.', libtcod.grey)
+                message('%s swings %s for %d hit points.', libtcod.grey, self.owner.name.capitalize(), target.name, damage)
                 target.fighter.take_damage(damage)
             elif choice < 20+20+20:
-                message(self.owner.name.capitalize() + ' bashes ' + target.name + ' for ' + str(damage) + ' hit points.', libtcod.dark_grey)
+                message('%s bashes %s for %d hit points.', libtcod.dark_grey, self.owner.name.capitalize(), target.name, damage)
                 target.fighter.take_damage(damage)
             elif choice < 20+20+20+20:
-                message(self.owner.name.capitalize() + ' clobbers ' + target.name + ' for ' + str(damage) + ' hit points.', libtcod.darker_grey)
+                message('%s clobbers %s for %d hit points.', libtcod.darker_grey, self.owner.name.capitalize(), target.name, damage)
                 target.fighter.take_damage(damage)
             else:
-                message(self.owner.name.capitalize() + ' smashes ' + target.name + ' for ' + str(damage) + ' hit points.', libtcod.sepia)
+                message('%s smashes %s for %d hit points.', libtcod.sepia, self.owner.name.capitalize(), target.name, damage)
                 target.fighter.take_damage(damage)
         else: 
-            message(self.owner.name.capitalize() + ' attacks ' + target.name + ' but it has no effect!')
+            message('%s attacks %s but it has no effect!', libtcod.white, self.owner.name.capitalize(), target.name)
             
     def heal(self, amount):
         #heal by the given amount, without going over the maximum
         self.hp += amount
         if self.hp > self.max_hp:
             self.hp = self.max_hp
+        autosave.touch_entity(self.owner)
 
 class BasicMonster:
     # AI for a basic monster.
     def take_turn(self):
-        #a basic monster takes its turn when in FOV only
+        #a basic monster takes its turn when it can see the player
         monster = self.owner
-        if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
+        if sees_player(monster):
             #move towards player if far away
             if monster.distance_to(player) >= 2:
-                monster.move_towards(player.x, player.y)
+                monster.path_towards(player.x, player.y)
             elif player.fighter.hp > 0:
                 monster.fighter.attack(player)
 
+class CowardlyMonster:
+    # AI for a monster that keeps its distance, fighting only when cornered.
+    def take_turn(self):
+        monster = self.owner
+        if sees_player(monster):
+            #run down the inverted player map, which leads away from the player
+            #and around corners instead of into the nearest dead end, pulled a
+            #little towards loot lying around on the way
+            dijkstra_maps.inverted('player', player_goals)
+            dijkstra_maps.field('items', item_goals)
+            flee = dijkstra_maps.combined([('player:inverted', 1.0), ('items', COWARD_GREED)])
+            if not monster.move_downhill(flee):
+                if monster.distance_to(player) < 2 and player.fighter.hp > 0:
+                    monster.fighter.attack(player)
+
 class Item:
     def __init__(self, use_function=None):
         self.use_function = use_function
         
-    #an item can be picked up and used
+    #an item can be picked up, used and dropped
     def pick_up(self):
         #add to inventory + remove from map
-        if len(inventory) >= 26:
+        if not inventory.add(self.owner): #stacks onto an identical item if there is one
             message('Your inventory is full, cannot pick up ' + self.owner.name + '.', libtcod.red)
         else:
-            inventory.append(self.owner) #add to inventory array
             objects.remove(self.owner) #remove from game map
+            touch_cell(self.owner.x, self.owner.y)
             message('You picked up a ' + self.owner.name + '!', libtcod.green)
             
     def use(self):
@@ -253,6 +370,83 @@ class Item:
             #consumable item
             if self.use_function() != 'cancelled':
                 inventory.remove(self.owner) #destroy after use unless it was cancelled for some reason 
+                
+    def drop(self):
+        #put the item back on the map under the player
+        inventory.remove(self.owner)
+        objects.append(self.owner)
+        self.owner.x = player.x
+        self.owner.y = player.y
+        self.owner.send_to_back() #also marks the cell as changed
+        autosave.touch_entity(self.owner)
+        message('You dropped a ' + self.owner.name + '.', libtcod.yellow)
+
+class Inventory:
+    #identical items share one stack, and every stack has its own slot letter.
+    #stacks are found by letter or by kind with a dictionary lookup, and
+    #picking up, using or dropping only touches the top of one stack.
+    def __init__(self, max_slots=26):
+        self.slots = {} #letter -> list of the stacked objects
+        self.kinds = {} #kind -> letter
+        self.free_letters = [chr(ord('a') + i) for i in range(max_slots)] #kept as a heap
+        self.count = 0 #items carried, over all stacks
+        
+    def kind_of(self, obj):
+        #items are identical if they look and work the same
+        return (obj.name, obj.item.use_function)
+        
+    def add(self, obj):
+        kind = self.kind_of(obj)
+        letter = self.kinds.get(kind)
+        if letter is None:
+            if not self.free_letters:
+                return False #no slot letter left for a new kind
+            letter = heapq.heappop(self.free_letters) #lowest free letter
+            self.slots[letter] = []
+            self.kinds[kind] = letter
+        self.slots[letter].append(obj)
+        self.count += 1
+        return True
+        
+    def remove(self, obj):
+        kind = self.kind_of(obj)
+        letter = self.kinds[kind]
+        stack = self.slots[letter]
+        if stack[-1] is obj:
+            stack.pop() #menus always hand out the top of the stack
+        else:
+            stack.remove(obj)
+        self.count -= 1
+        if not stack:
+            del self.slots[letter]
+            del self.kinds[kind]
+            heapq.heappush(self.free_letters, letter)
+            
+    def add_stack(self, letter, stack):
+        #put back a whole stack under its old letter, when loading a game
+        self.slots[letter] = stack
+        self.kinds[self.kind_of(stack[0])] = letter
+        self.free_letters.remove(letter)
+        heapq.heapify(self.free_letters)
+        self.count += len(stack)
+        
+    def get(self, letter):
+        #top object of the stack in that slot, or None
+        stack = self.slots.get(letter)
+        if stack:
+            return stack[-1]
+        return None
+        
+    def find(self, kind):
+        #slot letter holding that kind of item, or None
+        return self.kinds.get(kind)
+        
+    def stacks(self):
+        #(letter, top object, count) for every stack, in letter order
+        return [(letter, self.slots[letter][-1], len(self.slots[letter])) for letter in sorted(self.slots)]
+        
+    def __len__(self):
+        return self.count
                     
 ##########################################################################################
 # Blocked Tile Logic
@@ -270,6 +464,233 @@ def is_blocked(x, y):
         
     return False
 
+#############################################
+# Monster Perception - cached FOV
+# computing FOV from a monster's position is a full recompute of the map,
+# so visibility masks are kept in a small LRU cache. stationary guards and
+# repeated checks from the same tile only cost a dictionary lookup.
+#############################################
+
+class FovCache:
+    def __init__(self, max_bytes=FOV_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        
+        #(x, y, radius, light_walls, algo, map_version) -> (x0, y0, w, h, mask)
+        self.masks = collections.OrderedDict()
+        
+        #private FOV map so the player's fov_map is never disturbed
+        self.scratch_map = None
+        self.scratch_version = None
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+    def clear(self):
+        self.masks.clear()
+        self.used_bytes = 0
+        
+    def delete(self):
+        #free the native scratch map when the cache is replaced
+        if self.scratch_map is not None:
+            libtcod.map_delete(self.scratch_map)
+            self.scratch_map = None
+        self.scratch_version = None
+        self.clear()
+        
+    def get_mask(self, x, y, radius=TORCH_RADIUS, light_walls=FOV_LIGHT_WALLS, algo=FOV_ALGO):
+        key = (x, y, radius, light_walls, algo, map_version)
+        
+        #pop and re-insert so the entry becomes the most recently used one
+        entry = self.masks.pop(key, None)
+        if entry is not None:
+            self.hits += 1
+            self.masks[key] = entry
+            return entry
+        
+        self.misses += 1
+        entry = self.compute(x, y, radius, light_walls, algo)
+        self.masks[key] = entry
+        self.used_bytes += len(entry[4])
+        
+        #evict the least recently used masks until we are under the cap again
+        while self.used_bytes > self.max_bytes and len(self.masks) > 1:
+            (old_key, old_entry) = self.masks.popitem(last=False)
+            self.used_bytes -= len(old_entry[4])
+            self.evictions += 1
+        return entry
+        
+    def compute(self, x, y, radius, light_walls, algo):
+        if self.scratch_version != map_version:
+            #the terrain changed: resync the scratch map and drop stale masks
+            if self.scratch_map is None:
+                self.scratch_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
+            libtcod.map_copy(fov_map, self.scratch_map)
+            self.scratch_version = map_version
+            self.clear()
+            
+        libtcod.map_compute_fov(self.scratch_map, x, y, radius, light_walls, algo)
+        
+        #nothing outside the radius can be lit, so only store that box
+        if radius > 0:
+            x0 = max(0, x - radius)
+            y0 = max(0, y - radius)
+            x1 = min(MAP_WIDTH, x + radius + 1)
+            y1 = min(MAP_HEIGHT, y + radius + 1)
+        else:
+            (x0, y0, x1, y1) = (0, 0, MAP_WIDTH, MAP_HEIGHT)
+        w = x1 - x0
+        h = y1 - y0
+        
+        mask = bytearray(w * h)
+        i = 0
+        for my in range(y0, y1):
+            for mx in range(x0, x1):
+                if libtcod.map_is_in_fov(self.scratch_map, mx, my):
+                    mask[i] = 1
+                i += 1
+        return (x0, y0, w, h, mask)
+        
+    def is_visible(self, x, y, tx, ty, radius=TORCH_RADIUS, light_walls=FOV_LIGHT_WALLS, algo=FOV_ALGO):
+        #can a viewer standing on (x, y) see the tile (tx, ty)?
+        (x0, y0, w, h, mask) = self.get_mask(x, y, radius, light_walls, algo)
+        if tx < x0 or ty < y0 or tx >= x0 + w or ty >= y0 + h:
+            return False
+        return mask[(ty - y0) * w + (tx - x0)] == 1
+        
+    def can_see(self, viewer, target, radius=TORCH_RADIUS):
+        return self.is_visible(viewer.x, viewer.y, target.x, target.y, radius)
+        
+    def stats(self):
+        lookups = self.hits + self.misses
+        if lookups > 0:
+            hit_rate = float(self.hits) / lookups
+        else:
+            hit_rate = 0.0
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': hit_rate, 'entries': len(self.masks), 'bytes': self.used_bytes}
+
+def sees_player(monster):
+    #out of torch range can't be seen, so skip the FOV for those
+    if monster.distance_to(player) > TORCH_RADIUS:
+        return False
+    return monster_fov.can_see(monster, player)
+
+#############################################
+# Dijkstra Maps
+# distance fields from sets of goal cells, computed in one pass each and
+# shared by every monster that wants them. a field is kept for the turn
+# and only recomputed when its goals or the terrain change.
+#############################################
+
+def player_goals():
+    return ((player.x, player.y),)
+
+def item_goals():
+    return tuple((obj.x, obj.y) for obj in objects if obj.item)
+
+def frontier_goals():
+    #unexplored floor next to explored tiles - where exploring leads next
+    goals = []
+    for x in range(1, MAP_WIDTH - 1):
+        for y in range(1, MAP_HEIGHT - 1):
+            if map[x][y].explored or map[x][y].blocked:
+                continue
+            if (map[x-1][y].explored or map[x+1][y].explored or
+                map[x][y-1].explored or map[x][y+1].explored):
+                goals.append((x, y))
+    return tuple(goals)
+
+class DijkstraMaps:
+    def __init__(self):
+        #name -> [goals, map_version, turn, generation, field]
+        self.fields = {}
+        #weights -> (generations of the inputs, combined field)
+        self.combined_fields = {}
+        self.costs = None
+        self.costs_version = None
+        self.computations = 0
+        
+    def walk_costs(self):
+        #1 for floor, 0 for walls; rebuilt only when the terrain changes
+        if self.costs_version != map_version:
+            self.costs = bytearray(MAP_WIDTH * MAP_HEIGHT)
+            for y in range(MAP_HEIGHT):
+                for x in range(MAP_WIDTH):
+                    if not map[x][y].blocked:
+                        self.costs[x + y * MAP_WIDTH] = 1
+            self.costs_version = map_version
+        return self.costs
+        
+    def compute(self, name, goals, goals_function):
+        entry = self.fields.get(name)
+        if entry is not None:
+            if entry[1] == map_version and entry[2] == game_turn:
+                return entry
+            if goals is None:
+                goals = goals_function()
+            if entry[0] == goals and entry[1] == map_version:
+                entry[2] = game_turn
+                return entry
+            generation = entry[3] + 1
+        else:
+            if goals is None:
+                goals = goals_function()
+            generation = 0
+        
+        self.computations += 1
+        field = libtcod.dijkstra_fill_using_costs(self.walk_costs(), MAP_WIDTH, MAP_HEIGHT, goals)
+        entry = [goals, map_version, game_turn, generation, field]
+        self.fields[name] = entry
+        return entry
+        
+    def field(self, name, goals_function):
+        #distance to the nearest goal; goals_function is only called once a turn
+        return self.compute(name, None, goals_function)[4]
+        
+    def inverted(self, name, goals_function, coefficient=FLEE_COEFFICIENT):
+        #flee map: scale the approach map by a negative coefficient and let it
+        #settle again, so fleeing monsters head for open space instead of corners
+        base = self.compute(name, None, goals_function)
+        inverted_name = name + ':inverted'
+        entry = self.fields.get(inverted_name)
+        if entry is not None and entry[0] == (base[3], coefficient) and entry[1] == base[1]:
+            return entry[4]
+        
+        goals = [(i % MAP_WIDTH, i // MAP_WIDTH, value * coefficient)
+                 for (i, value) in enumerate(base[4]) if value != float('inf')]
+        self.computations += 1
+        field = libtcod.dijkstra_fill_using_costs(self.walk_costs(), MAP_WIDTH, MAP_HEIGHT, goals)
+        generation = 0
+        if entry is not None:
+            generation = entry[3] + 1
+        self.fields[inverted_name] = [(base[3], coefficient), base[1], game_turn, generation, field]
+        return field
+        
+    def combined(self, weights):
+        #weighted sum of named fields, e.g. [('player', 1.0), ('items', 0.5)]
+        #fields must have been computed this turn with field() or inverted()
+        key = tuple(weights)
+        generations = tuple((self.fields[name][1], self.fields[name][3]) for (name, weight) in weights)
+        cached = self.combined_fields.get(key)
+        if cached is not None and cached[0] == generations:
+            return cached[1]
+        
+        total = [0.0] * (MAP_WIDTH * MAP_HEIGHT)
+        for (name, weight) in weights:
+            if weight == 0:
+                continue
+            field = self.fields[name][4]
+            #a field with no goals (no items left, say) is inf everywhere and
+            #would flatten the sum, so leave it out and use the others alone
+            if min(field) == float('inf'):
+                continue
+            for i in range(len(total)):
+                total[i] += field[i] * weight
+        self.combined_fields[key] = (generations, total)
+        return total
+
 ############################################# 
 # dungeon creation routines
 # using x/y + 1 it will ensure there is a separating wall!
@@ -300,13 +721,368 @@ def create_v_tunnel(y1, y2, x):
         map[x][y].blocked = False
         map[x][y].block_sight = False
         
+#############################################
+# Room Graph
+# the level split into regions - every room, plus each connected run of
+# tunnel between them - with a door wherever two regions touch. long
+# paths are planned door to door over this small graph first, then each
+# region on the way is crossed with an A* kept inside that region's box.
+#############################################
+
+def octile_distance(x0, y0, x1, y1):
+    dx = abs(x1 - x0)
+    dy = abs(y1 - y0)
+    return max(dx, dy) + 0.41 * min(dx, dy)
+
+def adjacent(a, b):
+    #true for the same cell or any of its eight neighbours
+    return abs(a[0] - b[0]) <= 1 and abs(a[1] - b[1]) <= 1
+
+class RoomGraph:
+    def __init__(self):
+        self.rooms = []
+        #region of every map cell: room index, corridor index after the rooms, or -1 for walls
+        self.region_ids = [-1] * (MAP_WIDTH * MAP_HEIGHT)
+        self.region_count = 0
+        #doors are ((x, y) in the lower region, (x, y) in the higher region, lower, higher)
+        self.doors = []
+        #region -> indices of the doors on its border
+        self.region_doors = {}
+        #region -> (x0, y0, x1, y1) box around its cells, to keep each A* local
+        self.region_boxes = []
+        #tunnel region -> its cell indices, and -> {cell: [(neighbour, step cost)]}
+        self.region_cells = {}
+        self.links = {}
+        #(region, door) -> [((door, region entered), cost, x, y)] for the other doors
+        #it reaches, (x, y) being the cell of the door in the region entered
+        self.edges = {}
+        
+    def add_room(self, room):
+        index = len(self.rooms)
+        self.rooms.append(room)
+        self.region_boxes.append((room.x1 + 1, room.y1 + 1, room.x2 - 1, room.y2 - 1))
+        for x in range(room.x1 + 1, room.x2):
+            for y in range(room.y1 + 1, room.y2):
+                self.region_ids[x + y * MAP_WIDTH] = index
+        return index
+        
+    def build(self):
+        #called once the level is carved: label the tunnels and find the doors
+        ids = self.region_ids
+        region = len(self.rooms)
+        for start in range(MAP_WIDTH * MAP_HEIGHT):
+            (x, y) = (start % MAP_WIDTH, start // MAP_WIDTH)
+            if ids[start] != -1 or map[x][y].blocked:
+                continue
+            #flood fill one connected run of tunnel, stopping at the sector edge so
+            #one tunnel network can't become a region that borders everything
+            sector = (x // REGION_SECTOR, y // REGION_SECTOR)
+            ids[start] = region
+            stack = [start]
+            cells = self.region_cells[region] = []
+            (left, top, right, bottom) = (x, y, x, y)
+            while stack:
+                i = stack.pop()
+                cells.append(i)
+                (cx, cy) = (i % MAP_WIDTH, i // MAP_WIDTH)
+                (left, top) = (min(left, cx), min(top, cy))
+                (right, bottom) = (max(right, cx), max(bottom, cy))
+                for (dx, dy) in ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)):
+                    (nx, ny) = (cx + dx, cy + dy)
+                    if nx < 0 or ny < 0 or nx >= MAP_WIDTH or ny >= MAP_HEIGHT:
+                        continue
+                    j = nx + ny * MAP_WIDTH
+                    if (nx // REGION_SECTOR, ny // REGION_SECTOR) != sector:
+                        continue
+                    if ids[j] == -1 and not map[nx][ny].blocked:
+                        ids[j] = region
+                        stack.append(j)
+            self.region_boxes.append((left, top, right, bottom))
+            region += 1
+        self.region_count = region
+        self.region_doors = dict((r, []) for r in range(region))
+        
+        #one door per separate stretch where two regions touch, and another every
+        #DOOR_SPACING cells along a long stretch: a tunnel that runs beside a room
+        #or meets it twice would otherwise send every route round to one far end
+        contacts = {}
+        for y in range(MAP_HEIGHT):
+            for x in range(MAP_WIDTH):
+                a = ids[x + y * MAP_WIDTH]
+                if a == -1:
+                    continue
+                for (dx, dy) in ((1, 0), (-1, 1), (0, 1), (1, 1)):
+                    (nx, ny) = (x + dx, y + dy)
+                    if nx < 0 or nx >= MAP_WIDTH or ny >= MAP_HEIGHT:
+                        continue
+                    b = ids[nx + ny * MAP_WIDTH]
+                    if b == -1 or b == a:
+                        continue
+                    if a < b:
+                        door = ((x, y), (nx, ny), a, b)
+                    else:
+                        door = ((nx, ny), (x, y), b, a)
+                    #(cell, cell, door index) of every contact seen so far between the pair
+                    seen = contacts.setdefault((door[2], door[3]), [])
+                    joined = None
+                    for (cell_a, cell_b, d) in seen:
+                        if adjacent(cell_a, door[0]) and adjacent(cell_b, door[1]):
+                            (door_x, door_y) = self.doors[d][0]
+                            if max(abs(door_x - door[0][0]), abs(door_y - door[0][1])) < DOOR_SPACING:
+                                joined = d
+                                break
+                    if joined is not None:
+                        seen.append((door[0], door[1], joined))
+                        continue
+                    seen.append((door[0], door[1], len(self.doors)))
+                    self.region_doors[door[2]].append(len(self.doors))
+                    self.region_doors[door[3]].append(len(self.doors))
+                    self.doors.append(door)
+                    
+        #the walk across each region from every door to its others, worked out
+        #once per level so a route only has to look them up
+        self.edges = {}
+        for r in range(self.region_count):
+            doors = self.region_doors[r]
+            cells = [self.door_cell(d, r) for d in doors]
+            #a walk costs the same both ways, so the last door's walks are read
+            #off the searches from all the others
+            walks = [self.walk_costs(r, x, y, cells) for (x, y) in cells[:-1]]
+            walks.append([row[-1] for row in walks] + [0])
+            for (d, row) in zip(doors, walks):
+                edges = []
+                for (e, cost) in zip(doors, row):
+                    if e != d and cost is not None:
+                        (cell_a, cell_b, a, b) = self.doors[e]
+                        if r == a:
+                            edges.append(((e, b), cost + step_cost(cell_a, cell_b), cell_b[0], cell_b[1]))
+                        else:
+                            edges.append(((e, a), cost + step_cost(cell_a, cell_b), cell_a[0], cell_a[1]))
+                self.edges[(r, d)] = edges
+                    
+    def region_at(self, x, y):
+        return self.region_ids[x + y * MAP_WIDTH]
+        
+    def door_cell(self, d, region):
+        #the cell of door d that lies inside region
+        (cell_a, cell_b, a, b) = self.doors[d]
+        if region == a:
+            return cell_a
+        return cell_b
+        
+    def region_links(self, region):
+        #the steps between the cells of a tunnel region, found once and then
+        #shared by every search over it
+        links = self.links.get(region)
+        if links is None:
+            ids = self.region_ids
+            links = self.links[region] = {}
+            for i in self.region_cells[region]:
+                (x, y) = (i % MAP_WIDTH, i // MAP_WIDTH)
+                steps = []
+                for (dx, dy) in ((-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)):
+                    (nx, ny) = (x + dx, y + dy)
+                    if nx < 0 or ny < 0 or nx >= MAP_WIDTH or ny >= MAP_HEIGHT:
+                        continue
+                    j = nx + ny * MAP_WIDTH
+                    if ids[j] == region:
+                        steps.append((j, step_cost((x, y), (nx, ny))))
+                links[i] = steps
+        return links
+        
+    def region_field(self, region, x, y):
+        #dijkstra from (x, y) over the cells of one tunnel region only, so it
+        #stays as small as the region. returns the distances keyed by cell index
+        links = self.region_links(region)
+        origin = x + y * MAP_WIDTH
+        dist = {origin: 0}
+        heap = [(0, origin)]
+        while heap:
+            (d, i) = heapq.heappop(heap)
+            if d > dist[i]:
+                continue
+            for (j, step) in links[i]:
+                nd = d + step
+                if j not in dist or nd < dist[j]:
+                    dist[j] = nd
+                    heapq.heappush(heap, (nd, j))
+        return dist
+        
+    def walk_costs(self, region, x, y, cells):
+        #cost of the cheapest walk inside region from (x, y) to each of cells, or
+        #None where there is none. rooms are open rectangles, where that is just
+        #the octile distance; a tunnel gets a dijkstra over its cells
+        if region < len(self.rooms):
+            return [octile_distance(x, y, cx, cy) for (cx, cy) in cells]
+        dist = self.region_field(region, x, y)
+        return [dist.get(cx + cy * MAP_WIDTH) for (cx, cy) in cells]
+        
+    def route(self, x0, y0, x1, y1):
+        #A* over (door, region entered), each edge costed by the walk across its
+        #region. returns the doors to go through in order, or None if none lead
+        #from the region of (x0, y0) to the one of (x1, y1)
+        start = self.region_at(x0, y0)
+        end = self.region_at(x1, y1)
+        start_doors = self.region_doors[start]
+        start_costs = self.walk_costs(start, x0, y0, [self.door_cell(d, start) for d in start_doors])
+        end_doors = self.region_doors[end]
+        end_costs = dict(zip(end_doors, self.walk_costs(end, x1, y1, [self.door_cell(d, end) for d in end_doors])))
+        dist = {}
+        came_from = {}
+        heap = []
+        for (d, cost) in zip(start_doors, start_costs):
+            if cost is not None:
+                (cell_a, cell_b, a, b) = self.doors[d]
+                if start == a:
+                    (node, (x, y)) = ((d, b), cell_b)
+                else:
+                    (node, (x, y)) = ((d, a), cell_a)
+                cost += step_cost(cell_a, cell_b)
+                if cost < dist.get(node, float('inf')):
+                    dist[node] = cost
+                    came_from[node] = None
+                    heapq.heappush(heap, (cost + ROUTE_HEURISTIC_WEIGHT * octile_distance(x, y, x1, y1), node))
+                    
+        #the search loop runs for every door a route looks at, so the octile
+        #heuristic is written out in it
+        closed = set()
+        while heap:
+            (estimate, node) = heapq.heappop(heap)
+            if node == 'end':
+                break
+            if node in closed:
+                continue
+            closed.add(node)
+            (d, region) = node
+            cost = dist[node]
+            if region == end and end_costs.get(d) is not None:
+                total = cost + end_costs[d]
+                if total < dist.get('end', float('inf')):
+                    dist['end'] = total
+                    came_from['end'] = node
+                    heapq.heappush(heap, (total, 'end'))
+            for (other, step, x, y) in self.edges[(region, d)]:
+                total = cost + step
+                if total < dist.get(other, float('inf')):
+                    dist[other] = total
+                    came_from[other] = node
+                    (dx, dy) = (abs(x - x1), abs(y - y1))
+                    if dx > dy:
+                        heapq.heappush(heap, (total + ROUTE_HEURISTIC_WEIGHT * (dx + 0.41 * dy), other))
+                    else:
+                        heapq.heappush(heap, (total + ROUTE_HEURISTIC_WEIGHT * (dy + 0.41 * dx), other))
+        if 'end' not in came_from:
+            return None
+        
+        route = []
+        node = came_from['end']
+        while node is not None:
+            route.append(node)
+            node = came_from[node]
+        route.reverse()
+        return route
+
+def step_cost(a, b):
+    #cost of one step between neighbouring cells, as A* counts it
+    if a[0] != b[0] and a[1] != b[1]:
+        return 1.41
+    return 1
+
+def path_cost(x, y, path):
+    #cost of walking path from (x, y)
+    cost = 0
+    for cell in path:
+        cost += step_cost((x, y), cell)
+        (x, y) = cell
+    return cost
+
+def shortcut_path(x0, y0, path):
+    #joined segments can step through a door and back, or wander into a box two
+    #regions share: cut out every loop, then every cell whose neighbours on the
+    #path are already next to each other, as one step is always cheaper than two
+    cells = [(x0, y0)]
+    index = {(x0, y0): 0}
+    for cell in path:
+        if cell in index:
+            for old in cells[index[cell] + 1:]:
+                del index[old]
+            del cells[index[cell] + 1:]
+            continue
+        while len(cells) > 1 and adjacent(cells[-2], cell):
+            del index[cells.pop()]
+        index[cell] = len(cells)
+        cells.append(cell)
+    return cells[1:]
+
+def hierarchical_path(x0, y0, x1, y1):
+    #path from (x0, y0) to (x1, y1) as a list of (x, y), origin excluded
+    costs = dijkstra_maps.walk_costs()
+    if octile_distance(x0, y0, x1, y1) <= DIRECT_PATH_DISTANCE:
+        #close by: one A* in a box around both ends is cheaper than any planning
+        bounds = (min(x0, x1) - DIRECT_PATH_MARGIN, min(y0, y1) - DIRECT_PATH_MARGIN,
+                  max(x0, x1) + DIRECT_PATH_MARGIN, max(y0, y1) + DIRECT_PATH_MARGIN)
+        path = libtcod.path_compute_using_costs(costs, MAP_WIDTH, MAP_HEIGHT, x0, y0, x1, y1,
+                                                mincost=1, bounds=bounds)
+        if path:
+            return path
+            
+    start = level_graph.region_at(x0, y0)
+    end = level_graph.region_at(x1, y1)
+    if start < 0 or end < 0:
+        #an end inside a wall is on no region: leave it to a plain A*
+        return libtcod.path_compute_using_costs(costs, MAP_WIDTH, MAP_HEIGHT, x0, y0, x1, y1, mincost=1)
+    route = []
+    if start != end:
+        route = level_graph.route(x0, y0, x1, y1)
+        if route is None:
+            return []
+            
+    #cross each region with an A* kept inside its box, from where the path came
+    #in to the door it leaves by, then step through the door into the next
+    path = []
+    crossings = []
+    (x, y) = (x0, y0)
+    region = start
+    for (d, entered) in route:
+        (door_x, door_y) = level_graph.door_cell(d, region)
+        path.extend(libtcod.path_compute_using_costs(costs, MAP_WIDTH, MAP_HEIGHT, x, y, door_x, door_y,
+                                                     mincost=1, bounds=level_graph.region_boxes[region]))
+        (x, y) = level_graph.door_cell(d, entered)
+        crossings.append(len(path))
+        path.append((x, y))
+        region = entered
+    path.extend(libtcod.path_compute_using_costs(costs, MAP_WIDTH, MAP_HEIGHT, x, y, x1, y1,
+                                                 mincost=1, bounds=level_graph.region_boxes[end]))
+    
+    #the path has to pass through both cells of every door; plan the few cells
+    #around each crossing again so it can cut the corner instead. the last
+    #crossing goes first, so the indices of the earlier ones still hold
+    for k in reversed(crossings):
+        i = max(k - DOOR_WINDOW, 0)
+        j = min(k + DOOR_WINDOW, len(path) - 1)
+        if i == 0:
+            (ax, ay) = (x0, y0)
+        else:
+            (ax, ay) = path[i - 1]
+        (bx, by) = path[j]
+        bounds = (min(ax, bx) - 1, min(ay, by) - 1, max(ax, bx) + 1, max(ay, by) + 1)
+        detour = libtcod.path_compute_using_costs(costs, MAP_WIDTH, MAP_HEIGHT, ax, ay, bx, by,
+                                                  mincost=1, bounds=bounds)
+        if detour and path_cost(ax, ay, detour) < path_cost(ax, ay, path[i:j + 1]):
+            path[i:j + 1] = detour
+    return shortcut_path(x0, y0, path)
+
 ############################################# 
 # MAP DISPLAY:
 # actually creates the visible map.
 #############################################
 
 def make_map():
-    global map, player
+    global map, player, map_version, level_graph
+    
+    #new terrain invalidates anything cached against the old map
+    map_version += 1
+    level_graph = RoomGraph()
     
     #fill map with unblocked tiles
     map = [[ Tile(True)
@@ -340,9 +1116,7 @@ def make_map():
             
             # actually generate the room.
             create_room(new_room)
-            
-            # plop new objects in. for module 5, these are monsters!
-            place_objects(new_room)
+            level_graph.add_room(new_room)
             
             #determine center coords of this room.
             (new_x, new_y) = new_room.center()
@@ -355,6 +1129,7 @@ def make_map():
             if num_rooms == 0:
                 player.x = new_x
                 player.y = new_y
+                autosave.touch_entity(player)
                 
             #otherwise keep going to create the remaining rooms with the following instructions...
             else:
@@ -378,58 +1153,168 @@ def make_map():
             rooms.append(new_room)
             num_rooms += 1
             
+    # plop new objects in. for module 5, these are monsters!
+    place_objects(rooms)
+    
+    #keep the room/tunnel topology with the level for hierarchical pathfinding
+    level_graph.build()
+            
 #############################################
 # Monster Generation
 # Remember that monsters are a subset of objects.
 #############################################
 
-def place_objects(room):
-    #monster generation
-    num_monsters = libtcod.random_get_int(0, 0, MAX_ROOM_MONSTERS)
-    
-    for i in range(num_monsters):
-        #pick a random location for object generation
-        x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-        y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+class SpawnTable:
+    #weighted picks among the entries of a spawn table. the last field of every
+    #entry is a list of (from dungeon level, weight) steps; the weight at a level
+    #is the one of the highest step at or below it. cumulative weights are built
+    #once per level, then each pick is a binary search.
+    def __init__(self, entries):
+        self.entries = entries
+        self.cumulative = {}
         
-        #uses option b to create 4 monster entities based on 20/40/10/30% distribution
-        #checks to see if a tile is blocked. if not, step into these choices:
-        if not is_blocked(x, y):
-            choice = libtcod.random_get_int(0, 0, 100)
-            if choice < 20:
-                fighter_component = Fighter(hp=10, defense=0, power=3, death_function=monster_death)
-                ai_component = BasicMonster()
-                monster = Object(x, y, 'h', 'human', libtcod.pink, blocks=True, fighter=fighter_component, ai=ai_component)
-            elif choice < 20+40:
-                fighter_component = Fighter(hp=15, defense=0, power=4, death_function=monster_death)
-                ai_component = BasicMonster()
-                monster = Object(x, y, 'o', 'orc', libtcod.blue, blocks=True, fighter=fighter_component, ai=ai_component)
-            elif choice < 20+40+10:
-                fighter_component = Fighter(hp=20, defense=0, power=5, death_function=monster_death)
-                ai_component = BasicMonster()
-                monster = Object(x, y, 'd', 'dragon', libtcod.red, blocks=True, fighter=fighter_component, ai=ai_component)
-            else:
-                fighter_component = Fighter(hp=25, defense=0, power=6, death_function=monster_death)
-                ai_component = BasicMonster()
-                monster = Object(x, y, 'T', 'troll', libtcod.darker_green, blocks=True, fighter=fighter_component, ai=ai_component)
-                            
-            objects.append(monster)
+    def weight(self, entry, level):
+        weight = 0
+        for from_level, w in entry[-1]:
+            if level >= from_level:
+                weight = w
+        return weight
+        
+    def totals(self, level):
+        totals = self.cumulative.get(level)
+        if totals is None:
+            totals = []
+            total = 0
+            for entry in self.entries:
+                total += self.weight(entry, level)
+                totals.append(total)
+            self.cumulative[level] = totals
+        return totals
+        
+    def sample(self, level):
+        #one entry, or None if nothing spawns at this level
+        totals = self.totals(level)
+        if not totals or totals[-1] == 0:
+            return None
+        choice = libtcod.random_get_int(0, 0, totals[-1] - 1)
+        return self.entries[bisect.bisect_right(totals, choice)]
+        
+    def sample_many(self, level, count):
+        #count entries in one go, for filling a room or a whole level
+        totals = self.totals(level)
+        if not totals or totals[-1] == 0:
+            return []
+        top = totals[-1] - 1
+        entries = self.entries
+        return [entries[bisect.bisect_right(totals, libtcod.random_get_int(0, 0, top))]
+            for i in range(count)]
             
-    #item generation
-    num_items = libtcod.random_get_int(0, 0, MAX_ROOM_ITEMS)
+class SpawnDataListener:
+    #collects every monster/item block of the spawn data as its properties
+    def __init__(self):
+        self.entries = []
+        self.errors = []
+        
+    def new_struct(self, struct, name):
+        self.entries.append((libtcod.struct_get_name(struct), name, {}))
+        return True
+        
+    def new_flag(self, name):
+        return True
+        
+    def new_property(self, name, typ, value):
+        if typ == libtcod.TYPE_COLOR:
+            #the parser's color goes away with the parser, keep a copy
+            value = libtcod.Color(value.r, value.g, value.b)
+        self.entries[-1][2][name] = value
+        return True
+        
+    def end_struct(self, struct, name):
+        return True
+        
+    def error(self, msg):
+        self.errors.append(msg)
+        return True
+        
+def load_spawn_tables(filename=SPAWN_DATA):
+    #the monster and item spawn tables from the spawn data file
+    parser = libtcod.parser_new()
+    monster = libtcod.parser_new_struct(parser, 'monster')
+    item = libtcod.parser_new_struct(parser, 'item')
+    for struct in (monster, item):
+        libtcod.struct_add_property(struct, 'char', libtcod.TYPE_CHAR, True)
+        libtcod.struct_add_property(struct, 'color', libtcod.TYPE_COLOR, True)
+        libtcod.struct_add_list_property(struct, 'levels', libtcod.TYPE_INT, True)
+        libtcod.struct_add_list_property(struct, 'weights', libtcod.TYPE_INT, True)
+    for name in ('hp', 'defense', 'power'):
+        libtcod.struct_add_property(monster, name, libtcod.TYPE_INT, True)
+    libtcod.struct_add_value_list(monster, 'ai', sorted(SPAWN_AI), True)
+    libtcod.struct_add_value_list(item, 'use', sorted(SPAWN_USES), True)
+    
+    listener = SpawnDataListener()
+    libtcod.parser_run_cached(parser, filename, listener, version=SPAWN_DATA_VERSION)
+    libtcod.parser_delete(parser)
+    if listener.errors:
+        raise ValueError('%s: %s' % (filename, listener.errors[0]))
+    
+    monsters = []
+    items = []
+    for (kind, name, p) in listener.entries:
+        if len(p['levels']) != len(p['weights']):
+            raise ValueError('%s: levels and weights of %s differ in length' % (filename, name))
+        weights = zip(p['levels'], p['weights'])
+        if kind == 'monster':
+            monsters.append((name, p['char'], p['color'], p['hp'], p['defense'], p['power'], SPAWN_AI[p['ai']], weights))
+        else:
+            items.append((name, p['char'], p['color'], SPAWN_USES[p['use']], weights))
+    return (SpawnTable(monsters), SpawnTable(items))
+    
+def spawn_monster(entry, x, y):
+    name, char, color, hp, defense, power, ai_class, weights = entry
+    fighter_component = Fighter(hp=hp, defense=defense, power=power, death_function=monster_death)
+    ai_component = ai_class()
+    return Object(x, y, char, name, color, blocks=True, fighter=fighter_component, ai=ai_component)
+    
+def spawn_item(entry, x, y):
+    name, char, color, use_function, weights = entry
+    item_component = Item(use_function=use_function)
+    return Object(x, y, char, name, color, item=item_component)
+
+def place_objects(rooms):
+    #how many monsters and items go in each room
+    monster_counts = [libtcod.random_get_int(0, 0, MAX_ROOM_MONSTERS) for room in rooms]
+    item_counts = [libtcod.random_get_int(0, 0, MAX_ROOM_ITEMS) for room in rooms]
+    
+    #draw the whole level from the spawn tables in one go, then deal it out
+    monsters = monster_table.sample_many(dungeon_level, sum(monster_counts))
+    items = item_table.sample_many(dungeon_level, sum(item_counts))
+    next_monster = 0
+    next_item = 0
     
-    for i in range(num_items):
-        #pick a random location for object generation
-        x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-        y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+    for (room, num_monsters, num_items) in zip(rooms, monster_counts, item_counts):
+        #monster generation
+        for entry in monsters[next_monster:next_monster + num_monsters]:
+            #pick a random location for object generation
+            x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
+            y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+            
+            #checks to see if a tile is blocked. if not, the monster drawn from the
+            #spawn table for this dungeon level steps in
+            if not is_blocked(x, y):
+                objects.append(spawn_monster(entry, x, y))
+        next_monster += num_monsters
         
-        if not is_blocked(x, y):
-            #create a healing potion
-            item_component = Item(use_function=cast_heal)
-            item = Object(x, y, '!', 'healing potion', libtcod.violet, item=item_component)
+        #item generation
+        for entry in items[next_item:next_item + num_items]:
+            #pick a random location for object generation
+            x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
+            y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
             
-            objects.append(item)
-            item.send_to_back() #items will appear below other objects
+            if not is_blocked(x, y):
+                item = spawn_item(entry, x, y)
+                objects.append(item)
+                item.send_to_back() #items will appear below other objects
+        next_item += num_items
     
 #############################################
 # draw all objects in the list and map tiles
@@ -441,15 +1326,19 @@ def render_all():
     #declare global variables in this function
     global fov_map, color_dark_wall, color_dark_ground
     global color_light_wall, color_light_ground
-    global fov_recompute
+    global fov_recompute, fov_version
     
     # recompute the FOV if fov_recompute is flagged as True
     if fov_recompute:
     
         fov_recompute = False # reset fov_recompute as False to prevent infinite recompute loop
+        frame_timer.start('fov')
         libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+        fov_version += 1 #anything cached against the old FOV is stale now
+        frame_timer.stop('fov')
         
         #this determines if something is or is not visible.
+        frame_timer.start('tiles')
         for y in range(MAP_HEIGHT):
             for x in range(MAP_WIDTH):
                 visible = libtcod.map_is_in_fov(fov_map, x, y)
@@ -468,9 +1357,13 @@ def render_all():
                         libtcod.console_set_char_background(con, x, y, color_light_wall, libtcod.BKGND_SET)
                     else:
                         libtcod.console_set_char_background(con, x, y, color_light_ground, libtcod.BKGND_SET)
-                    map[x][y].explored = True
+                    if not map[x][y].explored:
+                        map[x][y].explored = True
+                        autosave.touch_tile(x, y) #the autosaved copy of this row is stale
+        frame_timer.stop('tiles')
     
     #draw all objects in list except player, then draw player
+    frame_timer.start('entities')
     for object in objects:
         if object != player:
             object.draw()
@@ -478,100 +1371,326 @@ def render_all():
 
     # display buffer 'con' information to the main terminal window    
     libtcod.console_blit(con, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0) 
+    frame_timer.stop('entities')
     
     #show player's stats - changed in module 7
+    frame_timer.start('panel')
     
-    #prepare to render the GUI panel
-    libtcod.console_set_default_background(panel, libtcod.black)
-    libtcod.console_clear(panel)
+    #update the GUI panel. each widget redraws its own region only when
+    #what it shows has changed; otherwise the panel is blitted as it is
+    message_pane.update(message_log.total)
     
-    #print the game messages one line at a time
-    y = 1
-    for (line, color) in game_msgs:
-        libtcod.console_set_default_foreground(panel, color)
-        libtcod.console_print_ex(panel, MSG_X, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
-        y += 1    
-            
     #show player HP - make it pretty
-    render_bar(1, 1, BAR_WIDTH, 'HP', player.fighter.hp, player.fighter.max_hp, libtcod.light_red, libtcod.darker_red)
+    hp_bar.update((player.fighter.hp, player.fighter.max_hp))
     
     #display the names of objects under the mouse
-    libtcod.console_set_default_foreground(panel, libtcod.light_gray)
-    libtcod.console_print_ex(panel, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, get_names_under_mouse())
+    look_line.update(get_names_under_mouse())
     
     # display the 'panel' offscreen console to the visible root console
     libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
+    frame_timer.stop('panel')
     
+#############################################
+# GUI - Console Pool
+# offscreen consoles for menus and popups, handed out by size and reused
+# instead of calling console_new every time a window opens
+#############################################
+
+class ConsolePool:
+    def __init__(self, max_free=MAX_FREE_CONSOLES):
+        self.max_free = max_free
+        self.free = {} #(width, height) -> consoles ready for reuse
+        self.free_count = 0
+        self.leased = {} #console -> (width, height)
+        self.allocated = 0 #consoles currently alive, leased or free
+        self.high_water = 0 #most consoles ever leased at once
+        
+    def acquire(self, width, height):
+        spare = self.free.get((width, height))
+        if spare:
+            window = spare.pop()
+            self.free_count -= 1
+        else:
+            window = libtcod.console_new(width, height)
+            self.allocated += 1
+            
+        #a reused console still holds whatever was drawn on it last time
+        libtcod.console_set_default_background(window, libtcod.black)
+        libtcod.console_clear(window)
+        
+        self.leased[window] = (width, height)
+        self.high_water = max(self.high_water, len(self.leased))
+        return window
+        
+    def release(self, window):
+        size = self.leased.pop(window)
+        if self.free_count >= self.max_free:
+            #enough spares already, give the memory back
+            libtcod.console_delete(window)
+            self.allocated -= 1
+        else:
+            self.free.setdefault(size, []).append(window)
+            self.free_count += 1
+            
+    def trim(self):
+        #delete every spare console
+        for spare in self.free.values():
+            for window in spare:
+                libtcod.console_delete(window)
+                self.allocated -= 1
+        self.free = {}
+        self.free_count = 0
+        
+    def stats(self):
+        return {'leased': len(self.leased), 'free': self.free_count,
+                'allocated': self.allocated, 'high_water': self.high_water}
+
 #############################################
 # GUI - Message Handling
 #############################################
 
-def message(new_msg, color = libtcod.white):
-    #split the message if necessary, among multiple lines
-    new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
-    
-    for line in new_msg_lines:
-        #if the buffer is full, remove the first line to make room for the new one
-        if len(game_msgs) == MSG_HEIGHT:
-            del game_msgs[0]
+wrap_cache = collections.OrderedDict()
+
+def wrap_text(text, width):
+    #textwrap.wrap with an LRU cache - combat spam repeats the same lines a lot
+    key = (text, width)
+    lines = wrap_cache.pop(key, None)
+    if lines is None:
+        lines = tuple(textwrap.wrap(text, width))
+        if len(wrap_cache) >= WRAP_CACHE_SIZE:
+            wrap_cache.popitem(last=False)
+    wrap_cache[key] = lines
+    return lines
+
+class MessageLog:
+    #every message of the session, up to a cap. the deque drops the oldest
+    #message itself once it is full, so logging stays constant-time.
+    #messages are stored as [template, args, color, text] and only formatted
+    #(and wrapped) if they are ever displayed or searched, so headless and
+    #bot runs never pay for the combat log.
+    def __init__(self, max_messages=MSG_HISTORY):
+        self.messages = collections.deque(maxlen=max_messages)
+        self.total = 0 #messages logged this session, including dropped ones
+        
+    def add(self, template, color, args=()):
+        self.messages.append([template, args, color, None])
+        self.total += 1
+        
+    def text(self, i):
+        entry = self.messages[i]
+        if entry[3] is None:
+            if entry[1]:
+                entry[3] = entry[0] % entry[1]
+            else:
+                entry[3] = entry[0]
+        return entry[3]
+        
+    def search(self, text, start=None):
+        #index of the newest message at or before start containing text, or None
+        text = text.lower()
+        if start is None or start >= len(self.messages):
+            start = len(self.messages) - 1
+        for i in range(start, -1, -1):
+            if text in self.text(i).lower():
+                return i
+        return None
+        
+    def page(self, bottom, height, width):
+        #the wrapped lines of one screen, ending with message index bottom.
+        #only the messages that are actually visible get formatted and wrapped.
+        lines = []
+        i = bottom
+        while i >= 0 and len(lines) < height:
+            color = self.messages[i][2]
+            for line in reversed(wrap_text(self.text(i), width)):
+                lines.append((line, color, i))
+            i -= 1
+        lines = lines[:height]
+        lines.reverse()
+        return lines
+        
+    def last_lines(self, height, width):
+        return self.page(len(self.messages) - 1, height, width)
+
+def message(new_msg, color = libtcod.white, *args):
+    #new_msg may be a template with %-style args, formatted on first display
+    message_log.add(new_msg, color, args)
+        
+class MessageHistory:
+    #full-screen scrollback of the message log, open as a modal state
+    def __init__(self):
+        self.width = SCREEN_WIDTH - 2
+        self.height = SCREEN_HEIGHT - 2
+        self.window = console_pool.acquire(SCREEN_WIDTH, SCREEN_HEIGHT)
+        self.bottom = len(message_log.messages) - 1
+        self.query = ''
+        self.typing = False
+        self.match = None
+        
+    def draw(self):
+        window = self.window
+        libtcod.console_set_default_background(window, libtcod.black)
+        libtcod.console_clear(window)
+        libtcod.console_set_default_foreground(window, libtcod.light_gray)
+        libtcod.console_print_ex(window, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT,
+                                 'Message log (' + str(self.bottom + 1) + '/' + str(len(message_log.messages)) +
+                                 ') - arrows/PgUp/PgDn scroll, / search, n next match, Esc close')
+        
+        #draw only the page that is visible, highlighting the current match
+        y = 1
+        for (line, color, index) in message_log.page(self.bottom, self.height, self.width):
+            if index == self.match:
+                libtcod.console_set_default_background(window, libtcod.darker_yellow)
+                flag = libtcod.BKGND_SET
+            else:
+                flag = libtcod.BKGND_NONE
+            libtcod.console_set_default_foreground(window, color)
+            libtcod.console_print_ex(window, 1, y, flag, libtcod.LEFT, line)
+            y += 1
+            
+        if self.typing:
+            libtcod.console_set_default_foreground(window, libtcod.white)
+            libtcod.console_print_ex(window, 1, SCREEN_HEIGHT - 1, libtcod.BKGND_NONE, libtcod.LEFT, '/' + self.query + '_')
+            
+        libtcod.console_blit(window, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, 0, 0, 0)
         
-        #add the new line as a tuple, with the text and the color
-        game_msgs.append((line, color))
+    def handle_key(self, key):
+        #returns True once the viewer is closed
+        if self.typing:
+            #typing a search: Enter runs it, Esc abandons it
+            if key.vk == libtcod.KEY_ENTER:
+                self.typing = False
+                self.match = message_log.search(self.query, self.bottom)
+                if self.match is not None:
+                    self.bottom = self.match
+            elif key.vk == libtcod.KEY_ESCAPE:
+                self.typing = False
+            elif key.vk == libtcod.KEY_BACKSPACE:
+                self.query = self.query[:-1]
+            elif key.c >= 32:
+                self.query += chr(key.c)
+            return False
+            
+        if key.vk == libtcod.KEY_ESCAPE:
+            console_pool.release(self.window)
+            return True
+        elif key.vk == libtcod.KEY_UP:
+            self.bottom -= 1
+        elif key.vk == libtcod.KEY_DOWN:
+            self.bottom += 1
+        elif key.vk == libtcod.KEY_PAGEUP:
+            self.bottom -= self.height
+        elif key.vk == libtcod.KEY_PAGEDOWN:
+            self.bottom += self.height
+        elif key.vk == libtcod.KEY_HOME:
+            self.bottom = 0
+        elif key.vk == libtcod.KEY_END:
+            self.bottom = len(message_log.messages) - 1
+        elif chr(key.c) == '/':
+            self.typing = True
+            self.query = ''
+        elif chr(key.c) == 'n' and self.query:
+            #next (older) match
+            self.match = message_log.search(self.query, self.bottom - 1)
+            if self.match is not None:
+                self.bottom = self.match
+        self.bottom = max(0, min(self.bottom, len(message_log.messages) - 1))
+        return False
 
 ############################################# 
-# Menu Function
+# Menu Function - Modal UI
+# menus and viewers are states of the main loop rather than loops of their
+# own: the main loop keeps polling sys_check_for_event, draws the open
+# modal over the game every frame and hands it the keys. nothing ever
+# blocks in console_wait_for_keypress.
 #############################################
 
-def menu(header, options, width):
-    if len(options) > 26: raise ValueError('Cannot have a menu with more than 26 options.')
-    
-    #calculate total height for the header after autowrap and one line per option
-    header_height = libtcod.console_get_height_rect(con, 0, 0, width, SCREEN_HEIGHT, header)
-    height = len(options) + header_height
-    
-    #create another offscreen console for the menu's window
-    window = libtcod.console_new(width, height)
-    
-    #print the header, with autowrap
-    libtcod.console_set_default_foreground(window, libtcod.white)
-    libtcod.console_print_rect_ex(window, 0, 0, width, height, libtcod.BKGND_NONE, libtcod.LEFT, header)
+def open_modal(modal):
+    modal_stack.append(modal)
     
-    y = header_height
-    letter_index = ord('a') #start the list of inventory items with ordinal letter a
-    for option_text in options:
-        text = '(' + chr(letter_index) + ') ' + option_text #converts ordinal to a string for selection
-        libtcod.console_print_ex(window, 0, y, libtcod.BKGND_NONE, libtcod.LEFT, text)
-        y += 1
-        letter_index += 1
+def handle_modal_key(key):
+    #give a key press to the topmost modal, closing it if it is done
+    modal = modal_stack[-1]
+    if modal.handle_key(key):
+        modal_stack.remove(modal)
         
-    #blit the contents of the inventory window to the root console in the middle of the screen
-    x = SCREEN_WIDTH/2 - width/2
-    y = SCREEN_HEIGHT/2 - height/2
-    libtcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.7) #last two values transparency%
-    
-    #present to the root console to the player and wait for key-press
-    libtcod.console_flush()
-    key = libtcod.console_wait_for_keypress(True)
+def draw_modals():
+    for modal in modal_stack:
+        modal.draw()
+
+class Menu:
+    def __init__(self, header, options, width, on_choice, letters=None):
+        if len(options) > 26: raise ValueError('Cannot have a menu with more than 26 options.')
+        
+        #options are lettered a, b, c... unless the caller gives its own letters
+        if letters is None:
+            letters = [chr(ord('a') + i) for i in range(len(options))]
+        self.letters = letters
+        self.on_choice = on_choice #called with the chosen index, or None if cancelled
+        
+        #calculate total height for the header after autowrap and one line per option
+        header_height = libtcod.console_get_height_rect(con, 0, 0, width, SCREEN_HEIGHT, header)
+        self.width = width
+        self.height = len(options) + header_height
         
-    #convert the ascii code from letter_index to an actual index; if it corresponds to an option, return it
-    index = key.c - ord('a') #offset
-    if index >= 0 and index < len(options): return index
-    return None
+        #borrow an offscreen console for the menu's window, kept until it closes
+        self.window = console_pool.acquire(self.width, self.height)
+        
+        #print the header, with autowrap
+        libtcod.console_set_default_foreground(self.window, libtcod.white)
+        libtcod.console_print_rect_ex(self.window, 0, 0, self.width, self.height, libtcod.BKGND_NONE, libtcod.LEFT, header)
+        
+        y = header_height
+        for (letter, option_text) in zip(letters, options):
+            text = '(' + letter + ') ' + option_text
+            libtcod.console_print_ex(self.window, 0, y, libtcod.BKGND_NONE, libtcod.LEFT, text)
+            y += 1
+            
+    def draw(self):
+        #blit the contents of the window to the root console in the middle of the screen
+        x = SCREEN_WIDTH/2 - self.width/2
+        y = SCREEN_HEIGHT/2 - self.height/2
+        libtcod.console_blit(self.window, 0, 0, self.width, self.height, 0, x, y, 1.0, 0.7) #last two values transparency%
+        
+    def handle_key(self, key):
+        #any key closes the menu; the one with an option's letter also picks it
+        console_pool.release(self.window)
+        key_char = chr(key.c)
+        if key_char in self.letters:
+            self.on_choice(self.letters.index(key_char))
+        else:
+            self.on_choice(None)
+        return True
+
+def menu(header, options, width, on_choice, letters=None):
+    open_modal(Menu(header, options, width, on_choice, letters))
     
 # Inventory Menu
 
-def inventory_menu(header):
-    #show a menu that lists all items presently in the inventory array
-    if len(inventory) == 0:
+def inventory_menu(header, on_choice):
+    #show a menu that lists every stack in the inventory, under its slot letter
+    #on_choice is called with the chosen item, or None
+    stacks = inventory.stacks()
+    if len(stacks) == 0:
         options = ['Inventory is empty, dogg.']
+        letters = None
     else:
-        options = [item.name for item in inventory]
+        options = []
+        for (letter, item, count) in stacks:
+            if count > 1:
+                options.append(item.name + ' (x' + str(count) + ')')
+            else:
+                options.append(item.name)
+        letters = [letter for (letter, item, count) in stacks]
         
-    index = menu(header, options, INVENTORY_WIDTH)
-    
-    #if an item was selected from this menu, return it
-    if index is None or len(inventory) == 0: return None
-    return inventory[index].item
+    def choose(index):
+        #if an item was selected from this menu, pass it on
+        if index is None or len(stacks) == 0:
+            on_choice(None)
+        else:
+            on_choice(stacks[index][1].item)
+        
+    menu(header, options, INVENTORY_WIDTH, choose, letters)
     
 ############################################# 
 # Combat Routines
@@ -600,6 +1719,25 @@ def player_move_or_attack(dx, dy):
  
 def handle_keys():
     global key;
+    
+    if key.vk == libtcod.KEY_F3:
+        #show or hide the frame timing overlay
+        frame_timer.toggle_overlay()
+        return 'didnt-take-turn'
+    elif key.vk == libtcod.KEY_F4:
+        #dump the frame timings to a file
+        frame_timer.dump()
+        return 'didnt-take-turn'
+    elif key.vk == libtcod.KEY_F5:
+        #start or stop profiling this session
+        session_profiler.toggle()
+        return 'didnt-take-turn'
+    
+    if modal_stack:
+        #an open menu gets every key press, and the game waits for it
+        if key.vk != libtcod.KEY_NONE:
+            handle_modal_key(key)
+        return 'didnt-take-turn'
      
     if key.vk == libtcod.KEY_ENTER and key.lalt:
         #Alt+Enter: toggle fullscreen
@@ -639,30 +1777,58 @@ def handle_keys():
                         break
             
             if key_char == 'i':
-                #show the inventory menu
-                chosen_item = inventory_menu('Press the key next to an item to use it, or any other to cancel.\n')
-                if chosen_item is not None:
-                    chosen_item.use()                
+                #show the inventory menu; the chosen item is used once a key is pressed
+                inventory_menu('Press the key next to an item to use it, or any other to cancel.\n', use_item)
+                    
+            if key_char == 'd':
+                #show the inventory and drop the chosen item
+                inventory_menu('Press the key next to an item to drop it, or any other to cancel.\n', drop_item)
+                    
+            if key_char == 'm':
+                #scroll back through the message log
+                open_modal(MessageHistory())
                 
             return 'didnt-take-turn'
 
 
+def use_item(item):
+    if item is not None:
+        item.use()
+        
+def drop_item(item):
+    if item is not None:
+        item.drop()
+
 #############################################
 # Mouselook command
 #############################################
         
+def touch_cell(x, y):
+    #note that the objects at (x, y) changed: moved, picked up, renamed...
+    global entity_stamp
+    entity_stamp += 1
+    cell_versions[(x, y)] = entity_stamp
+
 def get_names_under_mouse():
-    global mouse
+    global mouse, mouse_look_key, mouse_look_text
     
     #return a string with the names of all objects under the mouse
     (x, y) = (mouse.cx, mouse.cy)
     
+    #nothing to do unless the mouse moved, the FOV changed or something
+    #changed on the hovered cell since the last time
+    key = (x, y, fov_version, cell_versions.get((x, y), 0))
+    if key == mouse_look_key:
+        return mouse_look_text
+    
     #create a list with the names of all objects at the mouse's coordinates and in FOV
     names = [obj.name for obj in objects
              if obj.x == x and obj.y == y and libtcod.map_is_in_fov(fov_map, obj.x, obj.y)]
     
     names = ', '.join(names) #join the names, separated by commas
-    return names.capitalize()
+    mouse_look_key = key
+    mouse_look_text = names.capitalize()
+    return mouse_look_text
 
 #############################################
 # Traditional "look" command - via 
@@ -693,17 +1859,19 @@ def player_death(player):
     # turn player into a corpse
     player.char = '%'
     player.color = libtcod.dark_red
+    autosave.touch_entity(player)
     
 def monster_death(monster):
     # monster turns into a corpse that doesn't block/attack/move
-    message(monster.name.capitalize() + ' is dead.', libtcod.orange)
+    message('%s is dead.', libtcod.orange, monster.name.capitalize())
     monster.char = '%'
     monster.color = libtcod.dark_red
     monster.blocks = False
     monster.fighter = None
     monster.ai = None
     monster.name = 'remains of ' + monster.name
-    monster.send_to_back()
+    monster.send_to_back() #also marks the cell as changed for mouse-look
+    autosave.touch_entity(monster)
     
 def cast_heal():
     #heal the player when they drink a potion
@@ -714,6 +1882,675 @@ def cast_heal():
     message('Your wounds start to feel better!', libtcod.light_violet)
     player.fighter.heal(HEAL_AMOUNT)
  
+#############################################
+# Frame Timing
+# rolling per-phase timings of the main loop, shown in an overlay (F3)
+# and dumped to a file (F4) next to libtcod's own frame length and FPS
+#############################################
+
+class FrameTimer:
+    def __init__(self, window=FRAME_STATS_WINDOW):
+        self.window = window
+        self.samples = {} #phase -> deque of the most recent durations, in seconds
+        self.phases = [] #phases in the order they were first seen
+        self.started = {}
+        self.overlay = None #pooled console while the overlay is shown
+        
+    def start(self, phase):
+        self.started[phase] = timeit.default_timer()
+        
+    def stop(self, phase):
+        elapsed = timeit.default_timer() - self.started.pop(phase)
+        samples = self.samples.get(phase)
+        if samples is None:
+            samples = self.samples[phase] = collections.deque(maxlen=self.window)
+            self.phases.append(phase)
+        samples.append(elapsed)
+        
+    def stats(self, phase):
+        #(average, p95, p99) in milliseconds over the rolling window
+        ordered = sorted(self.samples[phase])
+        n = len(ordered)
+        average = sum(ordered) / n
+        p95 = ordered[min(n - 1, int(n * 0.95))]
+        p99 = ordered[min(n - 1, int(n * 0.99))]
+        return (average * 1000.0, p95 * 1000.0, p99 * 1000.0)
+        
+    def report(self):
+        lines = ['%-9s %8s %8s %8s' % ('phase', 'avg ms', 'p95 ms', 'p99 ms')]
+        for phase in self.phases:
+            lines.append('%-9s %8.2f %8.2f %8.2f' % ((phase,) + self.stats(phase)))
+        lines.append('libtcod: last frame %.2f ms, %d fps' %
+                     (libtcod.sys_get_last_frame_length() * 1000.0, libtcod.sys_get_fps()))
+        return lines
+        
+    def toggle_overlay(self):
+        if self.overlay is None:
+            self.overlay = console_pool.acquire(FRAME_OVERLAY_WIDTH, FRAME_OVERLAY_HEIGHT)
+        else:
+            console_pool.release(self.overlay)
+            self.overlay = None
+            
+    def draw_overlay(self):
+        if self.overlay is None:
+            return
+        libtcod.console_set_default_background(self.overlay, libtcod.black)
+        libtcod.console_clear(self.overlay)
+        libtcod.console_set_default_foreground(self.overlay, libtcod.light_green)
+        y = 0
+        for line in self.report()[:FRAME_OVERLAY_HEIGHT]:
+            libtcod.console_print_ex(self.overlay, 0, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
+            y += 1
+        libtcod.console_blit(self.overlay, 0, 0, FRAME_OVERLAY_WIDTH, FRAME_OVERLAY_HEIGHT, 0, 0, 0, 1.0, 0.6)
+        
+    def dump(self):
+        #write the current report to a timestamped file and say where it went
+        filename = time.strftime('frame-times-%Y%m%d-%H%M%S.txt')
+        f = open(filename, 'w')
+        f.write('\n'.join(self.report()) + '\n')
+        f.close()
+        message('Frame timings written to ' + filename + '.', libtcod.light_green)
+
+#############################################
+# Session Profiler
+# cProfile around a span of real play, started with F5 (or --profile on
+# the command line) and stopped with F5 again or on exit. each span is
+# written as a .prof file plus a text breakdown of libtcodpy calls
+# against game logic.
+#############################################
+
+class SessionProfiler:
+    def __init__(self):
+        self.profiler = None
+        
+    def running(self):
+        return self.profiler is not None
+        
+    def start(self):
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        
+    def stop(self):
+        #stop profiling and write the results; returns the base filename
+        self.profiler.disable()
+        base = time.strftime('profile-%Y%m%d-%H%M%S')
+        self.profiler.dump_stats(base + '.prof')
+        self.write_breakdown(self.profiler, base + '.txt')
+        self.profiler = None
+        return base
+        
+    def toggle(self):
+        if self.running():
+            base = self.stop()
+            message('Profile written to ' + base + '.prof/.txt.', libtcod.light_green)
+        else:
+            message('Profiling... press F5 again to stop.', libtcod.light_green)
+            self.start()
+            
+    def write_breakdown(self, profiler, filename):
+        f = open(filename, 'w')
+        stats = pstats.Stats(profiler, stream=f)
+        
+        #time spent inside libtcodpy calls made by the game, native code and
+        #ctypes included, against everything else
+        wrapper_time = 0.0
+        for ((path, line, function), (cc, nc, tt, ct, callers)) in stats.stats.items():
+            if not os.path.basename(path).startswith('libtcodpy'):
+                continue
+            for (caller, caller_stats) in callers.items():
+                if not os.path.basename(caller[0]).startswith('libtcodpy'):
+                    wrapper_time += caller_stats[3] #cumulative time of the calls from that caller
+        total = stats.total_tt or 1.0
+        game_time = total - wrapper_time
+        f.write('total %.3f s - libtcodpy %.3f s (%.1f%%), game logic %.3f s (%.1f%%)\n\n' %
+                (total, wrapper_time, wrapper_time * 100.0 / total, game_time, game_time * 100.0 / total))
+        
+        f.write('=== libtcodpy calls, by own time ===\n')
+        stats.sort_stats('time').print_stats('libtcodpy', 40)
+        f.write('=== game logic, by cumulative time ===\n')
+        stats.sort_stats('cumulative').print_stats(os.path.basename(__file__), 40)
+        f.write('=== everything, by own time ===\n')
+        stats.sort_stats('time').print_stats(40)
+        f.close()
+
+#############################################
+# New Game
+#############################################
+
+def new_game():
+    global player, objects, inventory, message_log, game_state, dungeon_level, game_turn
+    
+    #create object representing the player
+    fighter_component = Fighter(hp=30, defense=2, power=5, death_function=player_death)
+    player = Object(0, 0, '@', 'player', libtcod.white, blocks=True, fighter=fighter_component)
+    
+    objects = [player] #does it actually matter which order the entities are loaded in?
+    
+    # Make the map
+    dungeon_level = 1
+    make_map()
+    
+    #bucket of items, stacked by kind
+    inventory = Inventory()
+    
+    #create the log of game messages and their colors, starts empty
+    #the panel shows its last MSG_HEIGHT wrapped lines
+    message_log = MessageLog()
+    
+    game_turn = 0
+    game_state = 'playing'
+    initialize_fov()
+    
+    #a warm welcoming message!
+    message('Welcome stranger! Prepare to perish in the Tombs of the Ancient Kings.', libtcod.green)
+    
+def initialize_fov():
+    global fov_map, fov_recompute, monster_fov, dijkstra_maps
+    
+    # Generate a FOV map (also covers pathfinding visibility for a later module)
+    fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
+    for y in range(MAP_HEIGHT):
+        for x in range(MAP_WIDTH):
+            libtcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked) 
+            
+    #cached FOV from monster positions, for the monsters' own vision checks
+    if monster_fov is not None:
+        monster_fov.delete()
+    monster_fov = FovCache()
+    
+    #shared distance fields for monster AI, refreshed at most once per turn
+    dijkstra_maps = DijkstraMaps()
+    
+    #force the initial rendering of field of view, on a blank map
+    fov_recompute = True
+    libtcod.console_clear(con)
+
+#############################################
+# Save and Load
+# one binary file: a header, the RNG state, the tiles as one flag byte each,
+# the rooms, a table of entity names, the entities and inventory as fixed
+# records, then the message log. components are stored as ids into the
+# lists below, so new death functions, AIs or item uses go at their end.
+#############################################
+
+DEATH_FUNCTIONS = [None, player_death, monster_death]
+AI_CLASSES = [None, BasicMonster, CowardlyMonster]
+USE_FUNCTIONS = [None, cast_heal]
+GAME_STATES = ['playing', 'dead']
+
+#magic, version, map width and height, turn, dungeon level, game state
+SAVE_HEADER = struct.Struct('<4sHHHIHB')
+#x1, y1, x2, y2
+ROOM_RECORD = struct.Struct('<hhhh')
+#x, y, char, name index, color, flags, hp, max hp, defense, power,
+#death function id, ai id, use function id
+ENTITY_RECORD = struct.Struct('<hhHH3BBhhhhBBB')
+#color of a message
+COLOR_RECORD = struct.Struct('<3B')
+COUNT = struct.Struct('<I')
+SHORT_COUNT = struct.Struct('<H')
+
+#tile and entity flag bits
+TILE_BLOCKED = 1
+TILE_BLOCK_SIGHT = 2
+TILE_EXPLORED = 4
+ENTITY_BLOCKS = 1
+ENTITY_FIGHTER = 2
+ENTITY_ITEM = 4
+
+class SaveReader:
+    #walks a save file that has been read into memory in one go
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+        
+    def unpack(self, record):
+        values = record.unpack_from(self.data, self.pos)
+        self.pos += record.size
+        return values
+        
+    def bytes(self, length):
+        if self.pos + length > len(self.data):
+            raise ValueError('save file is truncated')
+        chunk = self.data[self.pos:self.pos + length]
+        self.pos += length
+        return chunk
+        
+    def text(self):
+        (length,) = self.unpack(SHORT_COUNT)
+        return self.bytes(length)
+        
+    def count(self, counter, item_size):
+        #a count of items at least item_size bytes each, checked against what is
+        #left so a corrupt one fails here instead of building a huge list
+        (count,) = self.unpack(counter)
+        if count * item_size > len(self.data) - self.pos:
+            raise ValueError('save file is truncated')
+        return count
+        
+def pack_text(text):
+    return SHORT_COUNT.pack(len(text)) + text
+    
+def pack_entity(obj, name_ids):
+    flags = 0
+    hp = max_hp = defense = power = death = 0
+    ai = use = 0
+    if obj.blocks:
+        flags |= ENTITY_BLOCKS
+    if obj.fighter:
+        flags |= ENTITY_FIGHTER
+        (hp, max_hp) = (obj.fighter.hp, obj.fighter.max_hp)
+        (defense, power) = (obj.fighter.defense, obj.fighter.power)
+        death = DEATH_FUNCTIONS.index(obj.fighter.death_function)
+    if obj.item:
+        flags |= ENTITY_ITEM
+        use = USE_FUNCTIONS.index(obj.item.use_function)
+    if obj.ai:
+        ai = AI_CLASSES.index(obj.ai.__class__)
+    return ENTITY_RECORD.pack(obj.x, obj.y, ord(obj.char), name_ids[obj.name],
+        obj.color.r, obj.color.g, obj.color.b, flags, hp, max_hp, defense, power, death, ai, use)
+        
+def unpack_entity(record, names):
+    (x, y, char, name, r, g, b, flags, hp, max_hp, defense, power, death, ai, use) = record
+    #ids out of range mean a corrupt save, reported like any other bad file
+    if not (0 <= x < MAP_WIDTH and 0 <= y < MAP_HEIGHT) or char > 255 or name >= len(names):
+        raise ValueError('bad entity in save file')
+    if death >= len(DEATH_FUNCTIONS) or ai >= len(AI_CLASSES) or use >= len(USE_FUNCTIONS):
+        raise ValueError('unknown component id in save file')
+    fighter_component = None
+    if flags & ENTITY_FIGHTER:
+        fighter_component = Fighter(hp=max_hp, defense=defense, power=power, death_function=DEATH_FUNCTIONS[death])
+        fighter_component.hp = hp
+    ai_component = None
+    if ai:
+        ai_component = AI_CLASSES[ai]()
+    item_component = None
+    if flags & ENTITY_ITEM:
+        item_component = Item(use_function=USE_FUNCTIONS[use])
+    return Object(x, y, chr(char), names[name], libtcod.Color(r, g, b), blocks=bool(flags & ENTITY_BLOCKS),
+        fighter=fighter_component, ai=ai_component, item=item_component)
+        
+def save_rng():
+    #copy of the default generator's state, as bytes
+    backup = libtcod.random_save(0)
+    state = ctypes.create_string_buffer(RNG_STATE_SIZE)
+    ctypes.memmove(state, backup, RNG_STATE_SIZE)
+    libtcod.random_delete(backup)
+    return state.raw
+    
+def load_rng(state):
+    backup = libtcod.random_save(0) #a generator of the right size to fill in
+    ctypes.memmove(backup, state, RNG_STATE_SIZE)
+    libtcod.random_restore(0, backup)
+    libtcod.random_delete(backup)
+    
+def pack_header():
+    return SAVE_HEADER.pack(SAVE_MAGIC, SAVE_VERSION, MAP_WIDTH, MAP_HEIGHT, game_turn,
+        dungeon_level, GAME_STATES.index(game_state)) + save_rng()
+        
+def pack_tiles(y0=0, y1=MAP_HEIGHT):
+    #one flag byte per tile of rows y0 to y1, indexed x + (y - y0) * MAP_WIDTH
+    tiles = bytearray(MAP_WIDTH * (y1 - y0))
+    for x in range(MAP_WIDTH):
+        column = map[x]
+        for y in range(y0, y1):
+            tile = column[y]
+            tiles[x + (y - y0) * MAP_WIDTH] = (tile.blocked and TILE_BLOCKED) | (tile.block_sight and TILE_BLOCK_SIGHT) | (tile.explored and TILE_EXPLORED)
+    return tiles
+    
+def pack_entities(names=None, record=None):
+    #rooms, names, entities and inventory. by default every entity is packed
+    #afresh; the autosave passes its own name table and a record function that
+    #reuses the records of entities that did not change
+    if record is None:
+        names = []
+        name_ids = {}
+        def record(obj):
+            if obj.name not in name_ids:
+                name_ids[obj.name] = len(names)
+                names.append(obj.name)
+            return pack_entity(obj, name_ids)
+            
+    #records first, since packing them can add to the name table
+    entities = [record(obj) for obj in objects]
+    #inventory stacks keep their letters
+    carried = []
+    for letter in sorted(inventory.slots):
+        stack = inventory.slots[letter]
+        carried.append(letter + SHORT_COUNT.pack(len(stack)))
+        carried.extend(record(obj) for obj in stack)
+        
+    parts = [SHORT_COUNT.pack(len(level_graph.rooms))]
+    for room in level_graph.rooms:
+        parts.append(ROOM_RECORD.pack(room.x1, room.y1, room.x2, room.y2))
+    #every distinct name once, entities refer to it by index
+    parts.append(SHORT_COUNT.pack(len(names)))
+    parts.extend(pack_text(name) for name in names)
+    parts.append(COUNT.pack(len(objects)))
+    parts.append(COUNT.pack(objects.index(player)))
+    parts.extend(entities)
+    parts.append(SHORT_COUNT.pack(len(inventory.slots)))
+    parts.extend(carried)
+    return ''.join(parts)
+    
+def pack_message_records(start, end):
+    #messages start to end of the log, as their final text
+    parts = []
+    for i in range(start, end):
+        color = message_log.messages[i][2]
+        parts.append(COLOR_RECORD.pack(color.r, color.g, color.b))
+        parts.append(pack_text(message_log.text(i)))
+    return ''.join(parts)
+    
+def pack_messages():
+    count = len(message_log.messages)
+    return COUNT.pack(message_log.total) + COUNT.pack(count) + pack_message_records(0, count)
+    
+def write_file_atomic(filename, data):
+    #write next to the file, then swap it in, so a crash leaves the old or the
+    #new version but never half of one
+    temp = filename + '.tmp'
+    f = open(temp, 'wb')
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    try:
+        os.rename(temp, filename)
+    except OSError:
+        #windows will not rename over an existing file
+        os.remove(filename)
+        os.rename(temp, filename)
+        
+def append_file(filename, data):
+    #add to the end of a file. a crash can leave the last write cut short, so
+    #readers have to check that the final record is whole
+    f = open(filename, 'ab')
+    f.write(data)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+        
+def save_game():
+    write_file_atomic(SAVE_FILE, pack_header() + str(pack_tiles()) + pack_entities() + pack_messages())
+    
+def load_game(data=None):
+    #loads SAVE_FILE, or a save put together in memory (see Autosave.recover)
+    global map, objects, player, inventory, message_log, game_state, dungeon_level, game_turn
+    global level_graph, map_version, cell_versions
+    
+    if data is None:
+        f = open(SAVE_FILE, 'rb')
+        data = f.read()
+        f.close()
+    reader = SaveReader(data)
+    
+    (magic, version, width, height, turn, level, state) = reader.unpack(SAVE_HEADER)
+    if magic != SAVE_MAGIC or version != SAVE_VERSION:
+        raise ValueError('not a version %d save file' % SAVE_VERSION)
+    if (width, height) != (MAP_WIDTH, MAP_HEIGHT):
+        raise ValueError('save file is for a %dx%d map' % (width, height))
+    load_rng(reader.bytes(RNG_STATE_SIZE))
+    
+    tiles = bytearray(reader.bytes(MAP_WIDTH * MAP_HEIGHT))
+    map = [[None] * MAP_HEIGHT for x in range(MAP_WIDTH)]
+    for x in range(MAP_WIDTH):
+        column = map[x]
+        for y in range(MAP_HEIGHT):
+            flags = tiles[x + y * MAP_WIDTH]
+            tile = Tile(bool(flags & TILE_BLOCKED), bool(flags & TILE_BLOCK_SIGHT))
+            tile.explored = bool(flags & TILE_EXPLORED)
+            column[y] = tile
+    map_version += 1
+    cell_versions = {}
+    
+    level_graph = RoomGraph()
+    count = reader.count(SHORT_COUNT, ROOM_RECORD.size)
+    for i in range(count):
+        (x1, y1, x2, y2) = reader.unpack(ROOM_RECORD)
+        if not (0 <= x1 < x2 < MAP_WIDTH and 0 <= y1 < y2 < MAP_HEIGHT):
+            raise ValueError('bad room in save file')
+        level_graph.add_room(Rect(x1, y1, x2 - x1, y2 - y1))
+    level_graph.build()
+    
+    count = reader.count(SHORT_COUNT, SHORT_COUNT.size)
+    names = [reader.text() for i in range(count)]
+    
+    count = reader.count(COUNT, ENTITY_RECORD.size)
+    (player_index,) = reader.unpack(COUNT)
+    if player_index >= count:
+        raise ValueError('bad player index in save file')
+    objects = [unpack_entity(reader.unpack(ENTITY_RECORD), names) for i in range(count)]
+    player = objects[player_index]
+    if not player.fighter:
+        raise ValueError('player without a fighter in save file')
+    
+    inventory = Inventory()
+    count = reader.count(SHORT_COUNT, 1 + SHORT_COUNT.size)
+    for i in range(count):
+        letter = reader.bytes(1)
+        size = reader.count(SHORT_COUNT, ENTITY_RECORD.size)
+        if size == 0:
+            raise ValueError('empty inventory stack in save file')
+        stack = [unpack_entity(reader.unpack(ENTITY_RECORD), names) for j in range(size)]
+        for obj in stack:
+            if not obj.item:
+                raise ValueError('carried entity that is not an item in save file')
+        inventory.add_stack(letter, stack)
+        
+    message_log = MessageLog()
+    (total,) = reader.unpack(COUNT)
+    count = reader.count(COUNT, COLOR_RECORD.size + SHORT_COUNT.size)
+    for i in range(count):
+        (r, g, b) = reader.unpack(COLOR_RECORD)
+        message_log.add(reader.text(), libtcod.Color(r, g, b))
+    message_log.total = total
+    
+    if state >= len(GAME_STATES):
+        raise ValueError('unknown game state in save file')
+    game_turn = turn
+    dungeon_level = level
+    game_state = GAME_STATES[state]
+    initialize_fov()
+
+#############################################
+# Autosave
+# every few turns the main thread packs what changed since the last autosave
+# and a worker thread writes it into AUTOSAVE_DIR, one file per part:
+# tile chunks with newly explored cells are replaced, the entities file is
+# rebuilt from cached records (only entities touched since are packed again),
+# and new messages are appended to a file next to the last full copy of the
+# log. the meta file with the turn and RNG state goes last. after a crash the
+# parts are put back together as a regular save and loaded; a clean exit
+# deletes them.
+#############################################
+
+class Autosave:
+    def __init__(self, directory=AUTOSAVE_DIR):
+        self.directory = directory
+        self.chunk_count = (MAP_HEIGHT + AUTOSAVE_ROWS - 1) // AUTOSAVE_ROWS
+        self.jobs = Queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = 0 #snapshots handed to the worker and not written yet
+        self.error = None
+        self.writes = 0 #files written, over the session
+        #bumped for every full copy of the message log, whose appended
+        #messages go to a file named after it
+        self.message_generation = 0
+        self.reset()
+        self.thread = threading.Thread(target=self.run, name='autosave')
+        self.thread.daemon = True
+        self.thread.start()
+        
+    def reset(self):
+        #after a new game, a load or a failed write nothing on disk can be trusted
+        self.dirty_chunks = set(range(self.chunk_count))
+        self.records = {} #entity -> its packed record
+        self.changed_entities = set() #entities whose record is stale
+        self.names = [] #name table of the records; only ever grows
+        self.name_ids = {}
+        self.last_entities = None
+        self.last_layout = None #objects and inventory stacks, as lists
+        self.last_message_total = None
+        self.appended = 0 #messages appended since the last full copy
+        
+    def touch_tile(self, x, y):
+        self.dirty_chunks.add(y // AUTOSAVE_ROWS)
+        
+    def touch_entity(self, obj):
+        #obj moved, got hurt, died... so its record has to be packed again
+        self.changed_entities.add(obj)
+        
+    def path(self, name):
+        return os.path.join(self.directory, name)
+        
+    def chunk_name(self, chunk):
+        return 'tiles-%02d' % chunk
+        
+    def appended_name(self, generation):
+        return 'messages-%d' % generation
+        
+    def entity_record(self, obj):
+        record = self.records.get(obj)
+        if record is None or obj in self.changed_entities:
+            if obj.name not in self.name_ids:
+                self.name_ids[obj.name] = len(self.names)
+                self.names.append(obj.name)
+            record = pack_entity(obj, self.name_ids)
+            self.records[obj] = record
+        return record
+        
+    def snapshot(self):
+        #called after a turn. returns False if the worker is still busy with the
+        #last snapshot, in which case the changes wait for the next one
+        if self.error is not None:
+            message('Autosave failed: ' + self.error, libtcod.red)
+            self.error = None
+            self.reset()
+        with self.lock:
+            if self.pending:
+                return False
+            self.pending += 1
+            
+        #(name, data, how) with how one of 'write', 'append' or 'remove'
+        files = []
+        for chunk in sorted(self.dirty_chunks):
+            y0 = chunk * AUTOSAVE_ROWS
+            y1 = min(MAP_HEIGHT, y0 + AUTOSAVE_ROWS)
+            files.append((self.chunk_name(chunk), str(pack_tiles(y0, y1)), 'write'))
+            
+        #nothing touched and nothing added, removed or reordered: the entities
+        #file on disk is still right
+        layout = (list(objects), [list(inventory.slots[letter]) for letter in sorted(inventory.slots)])
+        if self.changed_entities or layout != self.last_layout:
+            entities = pack_entities(self.names, self.entity_record)
+            self.changed_entities = set()
+            if len(self.records) > len(objects) + inventory.count:
+                #some entities are gone (used up items); forget their records
+                live = set(objects)
+                for stack in inventory.slots.values():
+                    live.update(stack)
+                for obj in list(self.records):
+                    if obj not in live:
+                        del self.records[obj]
+            if entities != self.last_entities:
+                files.append(('entities', entities, 'write'))
+            self.last_entities = entities
+        self.last_layout = layout
+            
+        #new messages are appended; a full copy starts a new file to append to
+        #once the appended ones would fill the log by themselves
+        new = message_log.total - (self.last_message_total or 0)
+        if self.last_message_total is None or self.appended + new > MSG_HISTORY:
+            old = self.appended_name(self.message_generation)
+            self.message_generation += 1
+            files.append(('messages', COUNT.pack(self.message_generation) + pack_messages(), 'write'))
+            files.append((old, None, 'remove'))
+            self.appended = 0
+        elif new:
+            end = len(message_log.messages)
+            files.append((self.appended_name(self.message_generation), pack_message_records(end - new, end), 'append'))
+            self.appended += new
+        files.append(('meta', pack_header(), 'write')) #last, so it never runs ahead of the rest
+        
+        self.dirty_chunks = set()
+        self.last_message_total = message_log.total
+        self.jobs.put(files)
+        return True
+        
+    def run(self):
+        #worker thread
+        while True:
+            files = self.jobs.get()
+            if files is None:
+                break
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                for (name, data, how) in files:
+                    if how == 'append':
+                        append_file(self.path(name), data)
+                    elif how == 'remove':
+                        if os.path.exists(self.path(name)):
+                            os.remove(self.path(name))
+                    else:
+                        write_file_atomic(self.path(name), data)
+                    self.writes += 1
+            except (IOError, OSError) as e:
+                self.error = str(e)
+            with self.lock:
+                self.pending -= 1
+                
+    def stop(self):
+        #let the worker finish what it has, then end it
+        self.jobs.put(None)
+        self.thread.join()
+        
+    def clear(self):
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            os.remove(self.path(name))
+        os.rmdir(self.directory)
+        
+    def read(self, name):
+        f = open(self.path(name), 'rb')
+        data = f.read()
+        f.close()
+        return data
+        
+    def recover(self):
+        #load the autosave left by a crash; False if there is none
+        if not os.path.exists(self.path('meta')):
+            return False
+        names = ['meta'] + [self.chunk_name(chunk) for chunk in range(self.chunk_count)] + ['entities']
+        parts = [self.read(name) for name in names]
+        
+        #the last full copy of the log, then whatever was appended to it
+        messages = self.read('messages')
+        (generation,) = COUNT.unpack_from(messages)
+        (total,) = COUNT.unpack_from(messages, COUNT.size)
+        (count,) = COUNT.unpack_from(messages, COUNT.size * 2)
+        appended = ''
+        if os.path.exists(self.path(self.appended_name(generation))):
+            appended = self.read(self.appended_name(generation))
+        #keep the whole records; a crash can cut the last one short
+        added = 0
+        size = 0
+        while size + COLOR_RECORD.size + SHORT_COUNT.size <= len(appended):
+            (length,) = SHORT_COUNT.unpack_from(appended, size + COLOR_RECORD.size)
+            end = size + COLOR_RECORD.size + SHORT_COUNT.size + length
+            if end > len(appended):
+                break
+            added += 1
+            size = end
+        parts.append(COUNT.pack(total + added) + COUNT.pack(count + added) + messages[COUNT.size * 3:] + appended[:size])
+        
+        load_game(''.join(parts))
+        #carry on past the files already there
+        self.message_generation = generation
+        return True
+
 #############################################
 # Initialization
 #############################################
@@ -725,32 +2562,70 @@ libtcod.sys_set_fps(LIMIT_FPS)
 # Initialize objects
 con = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT) #creates an offscreen buffer called 'con'
 
-#create object representing the player
-fighter_component = Fighter(hp=30, defense=2, power=5, death_function=player_death)
-player = Object(0, 0, '@', 'player', libtcod.white, blocks=True, fighter=fighter_component)
+#shared offscreen consoles for menus and popups
+console_pool = ConsolePool()
 
-objects = [player] #does it actually matter which order the entities are loaded in?
+#per-phase timings of the main loop
+frame_timer = FrameTimer()
 
-# Make the map
-make_map()
- 
-# Generate a FOV map (also covers pathfinding visibility for a later module)
-fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-for y in range(MAP_HEIGHT):
-    for x in range(MAP_WIDTH):
-        libtcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked) 
+#cProfile spans of real play; --profile starts one right away
+session_profiler = SessionProfiler()
+
+#bumped by make_map (and anything else that changes terrain) to invalidate caches
+map_version = 0
+
+#per-cell stamps of the last change to the objects there, see touch_cell
+cell_versions = {}
+entity_stamp = 0
+
+#names the spawn data uses for AI classes and item use functions
+SPAWN_AI = {'basic': BasicMonster, 'cowardly': CowardlyMonster}
+SPAWN_USES = {'heal': cast_heal}
+(monster_table, item_table) = load_spawn_tables()
+
+#bumped every time the FOV is recomputed
+fov_version = 0
 
-#force the initial rendering of field of view.
-fov_recompute = True 
+#monster vision cache, replaced by initialize_fov with every map
+monster_fov = None
 
-game_state = 'playing'
 player_action = None
 
-#bucket of items
-inventory = []
+#open menus and viewers, topmost last
+modal_stack = []
 
-#create the list of game messages and their colors, starts empty
-game_msgs = []
+#writes changes every few turns, on its own thread
+autosave = Autosave()
+
+#resume the game left by a crash, else the saved game. a new game only
+#starts if neither loads or --new asks for one, since quitting it replaces
+#SAVE_FILE
+recovered = False
+loaded = False
+failed = []
+if '--new' not in sys.argv:
+    try:
+        recovered = autosave.recover()
+    except (IOError, ValueError, struct.error):
+        failed.append('autosave')
+    if not recovered and os.path.exists(SAVE_FILE):
+        try:
+            load_game()
+            loaded = True
+        except (IOError, ValueError, struct.error):
+            failed.append('saved game')
+if recovered:
+    message('Recovered the autosave from turn %d.', libtcod.light_green, game_turn)
+elif not loaded:
+    new_game()
+if failed:
+    text = 'The ' + ' and the '.join(failed) + ' could not be loaded'
+    if not loaded:
+        text += ', starting a new game'
+    message(text + '.', libtcod.red)
+if not recovered:
+    autosave.clear() #left over from another game
+autosave.reset()
 
 #############################################
 # Status Bars
@@ -777,8 +2652,65 @@ def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
     libtcod.console_print_ex(panel, x + total_width / 2, y, libtcod.BKGND_NONE, libtcod.CENTER, 
                              name + ': ' + str(value) + '/' + str(maximum))
     
-#a warm welcoming message!
-message('Welcome stranger! Prepare to perish in the Tombs of the Ancient Kings.', libtcod.green)
+class PanelWidget:
+    #a region of the panel that remembers the inputs it was last drawn with
+    def __init__(self, x, y, width, height):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.last_inputs = None
+        
+    def update(self, inputs):
+        #redraw only if the inputs changed since the last frame
+        if inputs == self.last_inputs:
+            return False
+        self.last_inputs = inputs
+        
+        #wipe just this widget's region before drawing it again
+        libtcod.console_set_default_background(panel, libtcod.black)
+        libtcod.console_rect(panel, self.x, self.y, self.width, self.height, True, libtcod.BKGND_SET)
+        self.draw(inputs)
+        return True
+        
+    def draw(self, inputs):
+        pass
+        
+class BarWidget(PanelWidget):
+    #inputs are (value, maximum)
+    def __init__(self, x, y, width, name, bar_color, back_color):
+        PanelWidget.__init__(self, x, y, width, 1)
+        self.name = name
+        self.bar_color = bar_color
+        self.back_color = back_color
+        
+    def draw(self, inputs):
+        (value, maximum) = inputs
+        render_bar(self.x, self.y, self.width, self.name, value, maximum, self.bar_color, self.back_color)
+        
+class MessagePane(PanelWidget):
+    #inputs are the number of messages logged so far
+    def draw(self, inputs):
+        y = self.y
+        for (line, color, index) in message_log.last_lines(self.height, self.width):
+            libtcod.console_set_default_foreground(panel, color)
+            libtcod.console_print_ex(panel, self.x, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
+            y += 1
+            
+class TextLine(PanelWidget):
+    #inputs are the text to show
+    def __init__(self, x, y, width, color):
+        PanelWidget.__init__(self, x, y, width, 1)
+        self.color = color
+        
+    def draw(self, inputs):
+        libtcod.console_set_default_foreground(panel, self.color)
+        libtcod.console_print_ex(panel, self.x, self.y, libtcod.BKGND_NONE, libtcod.LEFT, inputs)
+
+#the widgets making up the panel
+hp_bar = BarWidget(1, 1, BAR_WIDTH, 'HP', libtcod.light_red, libtcod.darker_red)
+message_pane = MessagePane(MSG_X, 1, MSG_WIDTH, MSG_HEIGHT)
+look_line = TextLine(1, 0, SCREEN_WIDTH - 1, libtcod.light_gray)
 
 #############################################
 # Mouselook
@@ -787,23 +2719,40 @@ message('Welcome stranger! Prepare to perish in the Tombs of the Ancient Kings.'
 mouse = libtcod.Mouse()
 key = libtcod.Key()
 
+#mouse-look text is cached until the hovered cell, the FOV or the objects on it change
+mouse_look_key = None
+mouse_look_text = ''
+
 #############################################
 # MAIN LOOP
 #############################################
 
+if '--profile' in sys.argv:
+    session_profiler.start()
+
 while not libtcod.console_is_window_closed():
     
     #add mouselook functionality
+    frame_timer.start('events')
     libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE,key,mouse)
+    frame_timer.stop('events')
     
-    # render the screen via this function
+    # render the screen via this function, with any open menu on top
+    frame_timer.start('render')
     render_all()
+    draw_modals()
+    frame_timer.draw_overlay()
+    frame_timer.stop('render')
     
+    frame_timer.start('flush')
     libtcod.console_flush()
+    frame_timer.stop('flush')
 
     #utilize the clear method to remove objects from their old locations
+    frame_timer.start('clear')
     for object in objects:
         object.clear()
+    frame_timer.stop('clear')
 
     #handle keys and exit game if needed
     player_action = handle_keys()
@@ -811,8 +2760,30 @@ while not libtcod.console_is_window_closed():
         break
     
     if game_state == 'playing' and player_action != 'didnt-take-turn':
+        game_turn += 1
+        frame_timer.start('ai')
         for object in objects:
             #if object != player:
                 #print 'The ' + object.name + ' barfs!'
             if object.ai:
-                object.ai.take_turn() 
\ No newline at end of file
+                object.ai.take_turn()
+        frame_timer.stop('ai')
+        
+        if game_turn % AUTOSAVE_TURNS == 0:
+            frame_timer.start('autosave')
+            autosave.snapshot()
+            frame_timer.stop('autosave')
+
+#keep the game for next time; a dead character cannot be resumed. either
+#way the autosave is no longer needed
+autosave.stop()
+if game_state == 'dead':
+    if os.path.exists(SAVE_FILE):
+        os.remove(SAVE_FILE)
+else:
+    save_game()
+autosave.clear()
+
+#write out a profile still running when the game ends
+if session_profiler.running():
+    session_profiler.stop()